@@ -3,54 +3,74 @@ This file contains cleaning logic to use when loading the dataset.
 
 See the analysis for more information about each function.
 """
+import os
 import pipeline
+import numpy as np
 import pandas as pd
+from pipeline import cleaning
+
+UNNECESSARY_COLUMNS = ['projectid',
+                       'teacher_acctid',
+                       'schoolid',
+                       'school_ncesid',
+                       'school_city',
+                       'school_district',
+                       'school_county']
+
+FLAG_COLUMNS = ['school_charter',
+                'school_magnet',
+                'eligible_double_your_impact_match']
+
+MOSTLY_MISSING_COLUMNS = ['secondary_focus_subject', 'secondary_focus_area']
+
+DATE_COLUMNS = ['datefullyfunded', 'date_posted']
+
+IMPUTE_STRATEGIES = { 'school_metro': 'mode' }
 
 def unnecessary_columns(df):
-    return df.drop(columns=['projectid',
-                            'teacher_acctid',
-                            'schoolid',
-                            'school_ncesid',
-                            'school_city',
-                            'school_district',
-                            'school_county'])
+    return df.drop(columns=UNNECESSARY_COLUMNS)
 
 
 def fix_types(df):
-    for colname in ['school_charter',
-                    'school_magnet',
-                    'eligible_double_your_impact_match']:
-        df[colname] = (df[colname] == 't').astype(float)
+    for colname in FLAG_COLUMNS:
+        df[colname] = parse_flag(df[colname])
 
     return df
 
 
-def handle_missing(df):
-    df = df.drop(columns=['secondary_focus_subject',
-                          'secondary_focus_area'])
+def parse_flag(col):
+    return (col == 't').astype(float)
+
+
+def handle_missing(df, imputer=None):
+    df = df.drop(columns=MOSTLY_MISSING_COLUMNS)
 
     # Impute school_metro
-    pipeline.impute(df, 'school_metro', how='mode')
+    if not imputer:
+        imputer = pipeline.Imputer(IMPUTE_STRATEGIES)
+        imputer.fit(df)
 
+    df = imputer.transform(df)
     df = df.dropna()
-    return df
+    return df, imputer
 
 
-def handle_categorical(df, domains=None):
-    categorical_columns = pipeline.categorical_columns(df)
-
-    if domains:
-        pipeline.dummify_domain(df, domains, *categorical_columns)
+def handle_categorical(df, domains=None, sparse=False):
+    if domains is not None:
+        encoder = pipeline.Encoder(list(domains), domains, sparse=sparse)
     else:
-        domains = pipeline.dummify(df, *categorical_columns)
+        encoder = pipeline.Encoder(pipeline.categorical_columns(df),
+                                   sparse=sparse)
+        encoder.fit(df)
 
-    df = df.drop(columns=categorical_columns)
-    return df, domains
+    df = encoder.transform(df)
+    df = df.drop(columns=encoder.colnames)
+    return df, encoder.domains
 
 
-def discretize(df, columns, binner=None):
+def discretize(df, columns, binner=None, sparse=False):
     if not binner:
-        binner = pipeline.Binner(n_bins=4, colnames=columns)
+        binner = pipeline.Binner(n_bins=4, colnames=columns, sparse=sparse)
         binner.fit(df)
 
     df = binner.transform(df)
@@ -58,21 +78,120 @@ def discretize(df, columns, binner=None):
 
 
 def label(df, label_colname):
-    df[label_colname] = (
-        (df.datefullyfunded - df.date_posted)
-        .apply(lambda d: d.days > 60)
-        .astype(float)
-    )
-
-    df = df.drop(columns=['datefullyfunded', 'date_posted'])
+    df[label_colname] = funded_late(df)
+    df = df.drop(columns=DATE_COLUMNS)
     return df
 
 
-def clean(df, bin_columns, label_colname, domains=None, binner=None):
-    df = unnecessary_columns(df)
-    df = fix_types(df)
-    df = handle_missing(df)
-    df, domains = handle_categorical(df, domains)
-    df, binner = discretize(df, bin_columns, binner)
-    df = label(df, label_colname)
-    return df, domains, binner
+def funded_late(df):
+    days = (df['datefullyfunded'] - df['date_posted']).dt.days
+    return (days > 60).astype(float)
+
+
+def cleaning_pipeline(bin_columns, label_colname, domains=None, binner=None,
+                      sparse=False, imputer=None):
+    """
+    Returns the cleaning steps above as a pipeline. It can be fitted to a
+    training set and then used to clean test sets and new data.
+
+    Steps that are given fitted state (domains, binner or imputer) are not
+    fitted again.
+    """
+    return cleaning.CleaningPipeline([
+        ('unnecessary', cleaning.Drop(UNNECESSARY_COLUMNS)),
+        ('types', cleaning.Map(FLAG_COLUMNS, parse_flag)),
+        ('mostly_missing', cleaning.Drop(MOSTLY_MISSING_COLUMNS)),
+        ('impute', cleaning.Impute(IMPUTE_STRATEGIES, imputer)),
+        ('missing', cleaning.DropMissing()),
+        ('categorical', cleaning.Encode(domains=domains, sparse=sparse)),
+        ('discretize', cleaning.Bin(bin_columns, n_bins=4, sparse=sparse,
+                                    binner=binner)),
+        ('label', cleaning.Label(label_colname, funded_late,
+                                 drop=DATE_COLUMNS))
+    ])
+
+
+def clean(df, bin_columns, label_colname, domains=None, binner=None,
+          sparse=False, imputer=None):
+    """
+    Cleans the dataframe, fitting any state that is not given to it.
+
+    Returns the cleaned dataframe with the category domains, binner and imputer
+    used. Use cleaning_pipeline to keep the state together instead.
+    """
+    steps = cleaning_pipeline(bin_columns, label_colname, domains, binner,
+                              sparse, imputer)
+    df = steps.fit_transform(df)
+    named = steps.named_steps
+    return (df,
+            named['categorical'].encoder.domains,
+            named['discretize'].binner,
+            named['impute'].imputer)
+
+
+def fit_chunks(chunks, bin_columns, sparse=False):
+    """
+    Fits the cleaning state to a stream of raw chunks, holding only one chunk
+    in memory at a time.
+
+    Returns the category domains, binner and imputer to pass to clean.
+    """
+    imputer = pipeline.Imputer(IMPUTE_STRATEGIES)
+    uniques = {}
+    has_null = {}
+    binner = pipeline.Binner(n_bins=4, colnames=bin_columns, sparse=sparse)
+
+    for df in chunks:
+        df = fix_types(unnecessary_columns(df))
+        imputer.partial_fit(df)
+
+        # Keep the rows that handle_missing keeps
+        df = df.drop(columns=MOSTLY_MISSING_COLUMNS)
+        df = df.dropna(subset=df.columns.drop(list(IMPUTE_STRATEGIES)))
+
+        # Track values in order of appearance, like Series.unique. Columns
+        # with too many values are not categorical, so stop tracking them.
+        # Like categorical_columns, null counts as a value, except in columns
+        # that are imputed before categorical columns are found.
+        for colname in df.columns:
+            kind = pipeline.column_kind(df[colname].dtype)
+            if kind == 'object' and uniques.get(colname, {}) is not None:
+                seen = uniques.setdefault(colname, {})
+                seen.update(dict.fromkeys(df[colname].dropna().unique()))
+                has_null[colname] = has_null.get(colname, False) or \
+                    (colname not in IMPUTE_STRATEGIES and
+                     df[colname].isnull().any())
+                if len(seen) + has_null[colname] >= pipeline.MAX_CATEGORIES:
+                    uniques[colname] = None
+
+        binner.partial_fit(df)
+
+    domains = {colname: np.array(list(seen), dtype=object)
+               for colname, seen in uniques.items() if seen is not None}
+    return domains, binner, imputer
+
+
+def clean_chunked(filename, out_filename, bin_columns, label_colname,
+                  chunksize=100000, sparse=False, prefix='data/', **kwargs):
+    """
+    Cleans a CSV file one chunk at a time, appending the cleaned rows to
+    out_filename. Peak memory depends on the chunk size, not the file size.
+
+    The file is read twice: once to fit the cleaning state and once to clean
+    each chunk with it. Returns the category domains, binner and imputer so
+    that other data can be cleaned the same way.
+    """
+    chunks = pipeline.read_csv(filename, prefix, chunksize=chunksize, **kwargs)
+    domains, binner, imputer = fit_chunks(chunks, bin_columns, sparse)
+
+    if os.path.exists(prefix + out_filename):
+        os.remove(prefix + out_filename)
+
+    steps = cleaning_pipeline(bin_columns, label_colname, domains, binner,
+                              sparse, imputer)
+    chunks = pipeline.read_csv(filename, prefix, chunksize=chunksize, **kwargs)
+    for df in chunks:
+        pipeline.write_csv(steps.transform(df), out_filename, prefix,
+                           append=True)
+
+    return domains, binner, imputer
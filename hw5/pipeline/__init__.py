@@ -6,3 +6,9 @@ from .evaluate import *
 from .result import *
 from . import notebook
 from .binner import Binner
+from .cleaning import CleaningPipeline
+from .encoder import Encoder
+from .imputer import Imputer
+from .search import Search
+from .store import ModelStore
+from .splitter import TemporalSplitter
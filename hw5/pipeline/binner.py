@@ -1,30 +1,110 @@
+import numpy as np
 import pandas as pd
-from sklearn import preprocessing
+from scipy import sparse
+from .util import Reservoir, sparse_frame
+
+ENCODINGS = ['onehot', 'ordinal']
 
 class Binner:
     """
     Bins continuous columns into bins with the same number of members.
+
+    If encode is 'onehot', every bin gets a binary column, stored as sparse
+    columns if sparse is set. If encode is 'ordinal', every column gets a
+    single int8 column of bin codes from 0 to n_bins - 1.
+
+    The bin edges are the quantiles of each column, computed for all columns at
+    once. partial_fit can be used to fit the bins over a stream of chunks. The
+    bins are then fitted to a uniform random sample of sample_size rows.
     """
-    def __init__(self, n_bins, colnames):
+    def __init__(self, n_bins, colnames, sparse=False, sample_size=100000,
+                 seed=None, encode='onehot'):
+        if encode not in ENCODINGS:
+            raise Exception(f"Encoding \"{encode}\" is not supported.")
+
         self.n_bins = n_bins
         self.colnames = colnames
+        self.sparse = sparse
+        self.encode = encode
         self.new_colnames = self._new_colnames()
-        self.est = preprocessing.KBinsDiscretizer(n_bins=n_bins)
+        self.edges = None
+        self.reservoir = Reservoir(sample_size, seed)
 
 
     def fit(self, df):
-        df_sub = df[self.colnames]
-        self.est = self.est.fit(df_sub.values)
+        self.edges = self._edges(df[self.colnames].values)
+
+
+    def partial_fit(self, df):
+        self.reservoir.add(df[self.colnames].values)
+        self.edges = self._edges(self.reservoir.sample)
 
 
     def transform(self, df):
-        df_sub = df[self.colnames]
-        m = self.est.transform(df_sub.values).todense()
-        df_discretized = pd.DataFrame(m, columns=self.new_colnames)
-        return pd.merge(df, df_discretized, left_index=True, right_index=True)
+        return pd.concat([df, self.block(df)], axis=1)
+
+
+    def block(self, df):
+        """
+        Returns the bin columns as a dataframe with the same index as df.
+        """
+        codes = self.codes(df)
+        if self.encode == 'ordinal':
+            return pd.DataFrame(codes.T, index=df.index,
+                                columns=self.new_colnames)
+        elif self.sparse:
+            return sparse_frame(self._onehot(codes), df.index,
+                                self.new_colnames)
+        else:
+            return pd.DataFrame(self._onehot(codes),
+                                index=df.index,
+                                columns=self.new_colnames)
+
+
+    def codes(self, df):
+        """
+        Returns an array with a row of bin codes for every column. The codes
+        are int8 unless there are too many bins.
+        """
+        dtype = np.int8 if self.n_bins <= 128 else np.int64
+        codes = np.empty((len(self.colnames), len(df)), dtype=dtype)
+        for i, colname in enumerate(self.colnames):
+            # Values on an inner edge go in the bin above it, like
+            # KBinsDiscretizer
+            codes[i] = np.searchsorted(self.edges[i, 1:-1],
+                                       df[colname].values,
+                                       side='right')
+
+        return codes
+
+
+    def _edges(self, values):
+        quantiles = np.linspace(0, 1, self.n_bins + 1)
+        return np.nanquantile(values.astype(float), quantiles, axis=0).T
+
+
+    def _onehot(self, codes):
+        n_rows = codes.shape[1]
+        offsets = self.n_bins * np.arange(len(codes))[:, np.newaxis]
+        cols = codes + offsets
+        if self.sparse:
+            indices = cols.T.ravel()
+            indptr = np.arange(0, indices.size + 1, len(codes))
+            return sparse.csr_matrix((np.ones(indices.size), indices, indptr),
+                                     shape=(n_rows, len(self.new_colnames)))
+        else:
+            m = np.zeros((n_rows, len(self.new_colnames)))
+            rows = np.arange(n_rows)
+            for col in cols:
+                m[rows, col] = 1.0
+
+            return m
 
 
     def _new_colnames(self):
+        if self.encode == 'ordinal':
+            return [f"{colname}_bin" for colname in self.colnames]
+
         new_colnames = []
         for colname in self.colnames:
             for i in range(self.n_bins):
@@ -2,28 +2,29 @@
 This module contains helper functions for cleaning data and generating
 features.
 """
-import numpy as np
 import pandas as pd
 from sklearn import preprocessing
+from .encoder import Encoder
+from .imputer import Imputer
 
-def impute(df, colname, how='avg'):
+def impute(df, colname, how='avg', value=None):
     """
     Replaces all null values in the named column with an imputed value.
 
-    Adds a column recording which rows were imputed.
-    """
-    subst = np.nan
+    If value is given, it is used as the imputed value instead of computing
+    one from the column.
 
-    if how == 'avg':
-        subst = np.average(df.loc[df[colname].notnull(), colname])
-    elif how == 'mode':
-        subst = df[colname].mode()[0]
-    else:
-        raise Exception(f"\"how\" argument of \"{how}\" is not supported.")
+    Adds a column recording which rows were imputed. Use an Imputer instead to
+    impute test data with the statistics of the training data.
+    """
+    values = {colname: value} if value is not None else None
+    imputer = Imputer({colname: how}, values)
+    if value is None:
+        imputer.fit(df)
 
-    nulls = df[colname].isnull()
-    df.loc[nulls, colname] = subst
-    df[colname + '_imputed'] = nulls.astype(float)
+    imputed = imputer.transform(df[[colname]])
+    df[colname] = imputed[colname]
+    df[colname + '_imputed'] = imputed[colname + '_imputed']
 
 
 def dummify(df, *colnames):
@@ -41,21 +42,9 @@ def dummify_domain(df, domains, *colnames):
     """
     Converts columns containing discrete values into several binary columns.
 
-    This version uses pre-existing category domains.
+    This version uses pre-existing category domains. A binary column is added
+    for every value in each domain.
     """
-    for colname in colnames:
-        domain = domains[colname]
-        unknown = colname + '_is_unknown'
-        df[unknown] = 0.0
-
-        uniqs = df[colname].unique()
-        for uniq in uniqs:
-            if uniq in domain:
-                pretty_name = str(uniq).lower().replace(' ', '_')
-                new_colname = colname + '_is_' + pretty_name
-                df[new_colname] = (df[colname] == uniq).astype(float)
-            else:
-                df[unknown] = \
-                    (df[unknown].astype(bool) | (df[colname] == uniq)).astype(float)
-
+    encoder = Encoder(colnames, domains)
+    df[encoder.new_colnames()] = encoder.encode(df)
     return domains
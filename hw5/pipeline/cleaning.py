@@ -0,0 +1,279 @@
+"""
+This module contains a cleaning pipeline that is fitted once, on training data,
+and then cleans any number of test sets and scoring batches the same way.
+"""
+import joblib
+import numpy as np
+import pandas as pd
+from .binner import Binner
+from .encoder import Encoder
+from .explore import categorical_columns
+from .imputer import Imputer
+
+class CleaningPipeline:
+    """
+    Runs a list of (name, step) pairs in order, like an sklearn Pipeline. The
+    steps can be looked up by name in named_steps.
+
+    Steps work on the columns of the dataframe rather than on the dataframe
+    itself, so a run of column steps (everything except Apply) only replaces,
+    adds or removes columns. A new dataframe is built once at the end of the
+    run instead of after every step.
+
+    Steps built with fitted state (e.g. an existing imputer) are not fitted
+    again, so a pipeline made only of such steps is ready to transform. The
+    fitted pipeline can be saved and loaded with joblib.
+    """
+    def __init__(self, steps):
+        self.steps = steps
+        self.named_steps = dict(steps)
+        self.fitted = all(step.frozen for _, step in steps)
+
+
+    def fit(self, df):
+        self.fit_transform(df)
+        return self
+
+
+    def fit_transform(self, df):
+        """
+        Fits each step to the output of the steps before it, and returns the
+        cleaned dataframe.
+        """
+        columns = Columns.from_frame(df)
+        for _, step in self.steps:
+            if not step.frozen:
+                step.fit(columns)
+
+            columns = step.transform(columns)
+
+        self.fitted = True
+        return columns.frame()
+
+
+    def transform(self, df):
+        if not self.fitted:
+            raise Exception("Cleaning pipeline has not been fitted.")
+
+        columns = Columns.from_frame(df)
+        for _, step in self.steps:
+            columns = step.transform(columns)
+
+        return columns.frame()
+
+
+    def save(self, filename):
+        joblib.dump(self, filename)
+
+
+    def load(filename):
+        return joblib.load(filename)
+
+
+class Columns:
+    """
+    The columns of a dataframe being cleaned, stored as arrays that share an
+    index.
+
+    Supports enough of the dataframe interface (indexing by column name or
+    list of names, len, columns and index) for the fit methods of Imputer,
+    Encoder and Binner.
+    """
+    def __init__(self, index, arrays):
+        self.index = index
+        self.arrays = arrays
+
+
+    def from_frame(df):
+        return Columns(df.index, {colname: df[colname].array
+                                  for colname in df.columns})
+
+
+    @property
+    def columns(self):
+        return pd.Index(list(self.arrays))
+
+
+    def __len__(self):
+        return len(self.index)
+
+
+    def __getitem__(self, key):
+        if isinstance(key, list):
+            return pd.DataFrame({colname: self.arrays[colname]
+                                 for colname in key}, index=self.index)
+        else:
+            return pd.Series(self.arrays[key], index=self.index, name=key)
+
+
+    def set(self, columns):
+        """
+        Replaces or adds columns from a dictionary of series or a dataframe.
+        New columns go at the end, like assignment to a dataframe.
+        """
+        for colname in columns:
+            self.arrays[colname] = columns[colname].array
+
+
+    def drop(self, colnames):
+        for colname in colnames:
+            del self.arrays[colname]
+
+
+    def take(self, mask):
+        """
+        Keeps only the rows where the mask is true.
+        """
+        arrays = {colname: array[mask]
+                  for colname, array in self.arrays.items()}
+        return Columns(self.index[mask], arrays)
+
+
+    def frame(self):
+        return pd.DataFrame(self.arrays, index=self.index)
+
+
+class Drop:
+    """
+    Removes columns.
+    """
+    def __init__(self, colnames):
+        self.colnames = colnames
+        self.frozen = True
+
+
+    def transform(self, columns):
+        columns.drop(self.colnames)
+        return columns
+
+
+class Map:
+    """
+    Replaces each of the named columns with func(column).
+    """
+    def __init__(self, colnames, func):
+        self.colnames = colnames
+        self.func = func
+        self.frozen = True
+
+
+    def transform(self, columns):
+        columns.set({colname: self.func(columns[colname])
+                     for colname in self.colnames})
+        return columns
+
+
+class Apply:
+    """
+    Replaces the dataframe with func(df, **kwargs), for changes that are not
+    column by column. The dataframe is built before func is called.
+    """
+    def __init__(self, func, **kwargs):
+        self.func = func
+        self.kwargs = kwargs
+        self.frozen = True
+
+
+    def transform(self, columns):
+        df = self.func(columns.frame(), **self.kwargs)
+        return Columns.from_frame(df)
+
+
+class Impute:
+    """
+    Imputes columns with an Imputer. strategies maps column names to 'avg' or
+    'mode'.
+    """
+    def __init__(self, strategies, imputer=None):
+        self.imputer = imputer or Imputer(strategies)
+        self.frozen = imputer is not None
+
+
+    def fit(self, columns):
+        self.imputer.fit(columns)
+
+
+    def transform(self, columns):
+        columns.set(self.imputer.columns(columns))
+        return columns
+
+
+class DropMissing:
+    """
+    Removes rows with a null value in any column.
+    """
+    def __init__(self):
+        self.frozen = True
+
+
+    def transform(self, columns):
+        keep = np.ones(len(columns), dtype=bool)
+        for array in columns.arrays.values():
+            keep &= ~np.asarray(pd.isnull(array))
+
+        return columns if keep.all() else columns.take(keep)
+
+
+class Encode:
+    """
+    Replaces categorical columns with binary columns using an Encoder.
+
+    If domains is not given, the encoder is fitted to the named columns, or to
+    the columns that categorical_columns finds if there are none.
+    """
+    def __init__(self, colnames=None, domains=None, sparse=False):
+        self.colnames = colnames
+        self.sparse = sparse
+        self.encoder = Encoder(list(domains or []), domains, sparse)
+        self.frozen = domains is not None
+
+
+    def fit(self, columns):
+        colnames = self.colnames or categorical_columns(columns)
+        self.encoder = Encoder(colnames, sparse=self.sparse)
+        self.encoder.fit(columns)
+
+
+    def transform(self, columns):
+        columns.set(self.encoder.block(columns))
+        columns.drop(self.encoder.colnames)
+        return columns
+
+
+class Bin:
+    """
+    Replaces continuous columns with bin columns using a Binner.
+    """
+    def __init__(self, colnames, n_bins=4, sparse=False, encode='onehot',
+                 binner=None):
+        self.binner = binner or Binner(n_bins, colnames, sparse=sparse,
+                                       encode=encode)
+        self.frozen = binner is not None
+
+
+    def fit(self, columns):
+        self.binner.fit(columns)
+
+
+    def transform(self, columns):
+        columns.set(self.binner.block(columns))
+        columns.drop(self.binner.colnames)
+        return columns
+
+
+class Label:
+    """
+    Adds a label column computed by func from the columns, and removes the
+    columns in drop.
+    """
+    def __init__(self, colname, func, drop=()):
+        self.colname = colname
+        self.func = func
+        self.drop = list(drop)
+        self.frozen = True
+
+
+    def transform(self, columns):
+        columns.set({self.colname: self.func(columns)})
+        columns.drop(self.drop)
+        return columns
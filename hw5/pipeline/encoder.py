@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from .util import sparse_frame
+
+class Encoder:
+    """
+    Converts columns containing discrete values into several binary columns.
+
+    Each column is factorized once against its domain, and the binary columns
+    for all of the columns are written into a single block. Values that are not
+    in a column's domain are flagged in its "_is_unknown" column.
+    """
+    def __init__(self, colnames, domains=None, sparse=False):
+        self.colnames = colnames
+        self.domains = domains or {}
+        self.sparse = sparse
+
+
+    def fit(self, df):
+        for colname in self.colnames:
+            self.domains[colname] = df[colname].unique()
+
+
+    def transform(self, df):
+        return pd.concat([df, self.block(df)], axis=1)
+
+
+    def block(self, df):
+        """
+        Returns the binary columns as a dataframe with the same index as df.
+        """
+        m = self.encode(df)
+        new_colnames = self.new_colnames()
+        if self.sparse:
+            return sparse_frame(m, df.index, new_colnames)
+        else:
+            return pd.DataFrame(m, index=df.index, columns=new_colnames)
+
+
+    def encode(self, df):
+        """
+        Returns the binary columns as a single array, or as a sparse matrix if
+        the encoder is sparse.
+        """
+        n_rows = len(df)
+        rows = np.arange(n_rows)
+        cols = np.empty((len(self.colnames), n_rows), dtype=np.int64)
+
+        offset = 0
+        for i, colname in enumerate(self.colnames):
+            domain = self._domain(colname)
+            codes = pd.Categorical(df[colname], categories=domain).codes
+
+            # Code -1 (unknown) lands on the _is_unknown column at offset
+            cols[i] = offset + 1 + codes
+            offset += len(domain) + 1
+
+        if self.sparse:
+            data = np.ones(cols.size)
+            return sparse.csr_matrix((data, (np.tile(rows, len(cols)),
+                                             cols.ravel())),
+                                     shape=(n_rows, offset))
+        else:
+            m = np.zeros((n_rows, offset))
+            for col in cols:
+                m[rows, col] = 1.0
+
+            return m
+
+
+    def new_colnames(self):
+        new_colnames = []
+        for colname in self.colnames:
+            new_colnames.append(colname + '_is_unknown')
+            for value in self._domain(colname):
+                pretty_name = str(value).lower().replace(' ', '_')
+                new_colnames.append(colname + '_is_' + pretty_name)
+
+        return new_colnames
+
+
+    def _domain(self, colname):
+        domain = pd.Series(self.domains[colname])
+        return domain[domain.notnull()].values
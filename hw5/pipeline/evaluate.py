@@ -30,18 +30,43 @@ def time_split(df, colname, begin, end, n_splits, remove_date=False):
     The training sets are cumulative in that each subsequent training set
     contains all earlier training sets. The test sets are always the most
     recent split.
+
+    The dataframe is sorted by the date column once, and every training and
+    test set is a slice of the sorted dataframe, so rows come back in date
+    order.
     """
-    window = (end - begin) / n_splits
-    thresholds = [begin + window * i for i in range(1, n_splits + 1)]
-    splits = \
-        [(df[df[colname] <= train_set_end],
-          df[(df[colname] > train_set_end) & (df[colname] <= test_set_end)])
-         for train_set_end, test_set_end
-         in zip(thresholds, thresholds[1:])]
+    order, slices = time_split_indices(df, colname, begin, end, n_splits)
+
+    if np.array_equal(order, np.arange(len(order))):
+        df_sorted = df
+    else:
+        df_sorted = df.iloc[order]
 
     if remove_date:
-        splits = [(df_train.drop(columns=[colname]),
-                   df_test.drop(columns=[colname]))
-                   for df_train, df_test in splits]
+        df_sorted = df_sorted.drop(columns=[colname])
+
+    return [(df_sorted.iloc[train], df_sorted.iloc[test])
+            for train, test in slices]
+
+
+def time_split_indices(df, colname, begin, end, n_splits):
+    """
+    Returns the positions that sort the dataframe by the date column, along
+    with a list of (train, test) slices into that sorted order. See time_split.
+
+    The slices can be applied to any arrays in sorted order, e.g.
+    X[order][train].
+    """
+    dates = df[colname].values
+    order = np.argsort(dates, kind='mergesort')
+    sorted_dates = dates[order]
+
+    window = (end - begin) / n_splits
+    thresholds = [begin + window * i for i in range(1, n_splits + 1)]
+    bounds = np.searchsorted(sorted_dates,
+                             np.array(thresholds, dtype=sorted_dates.dtype),
+                             side='right')
 
-    return splits
+    slices = [(slice(0, train_end), slice(train_end, test_end))
+              for train_end, test_end in zip(bounds, bounds[1:])]
+    return order, slices
@@ -2,9 +2,18 @@
 This module contains functions that explore distributions of values and
 relationships between columns.
 """
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+from .util import Reservoir, worker_count
+
+# Columns with fewer distinct values than this (counting null) can be
+# categorical
+MAX_CATEGORIES = 100
+
+# HyperLogLog uses 2 ** HLL_PRECISION registers
+HLL_PRECISION = 12
 
 def extrema(narray):
     """
@@ -13,58 +22,111 @@ def extrema(narray):
     return (np.min(narray), np.max(narray))
 
 
-def unique_columns(df):
+def profile(df, approximate=False, n_jobs=None):
+    """
+    Returns a dataframe with one row of statistics for every column:
+    - kind: one of bool, numeric, datetime, category or object
+    - count and missing: the number of present and null values
+    - distinct: the number of distinct present values
+    - binary, unique and categorical: the flags used by the helpers below
+    - min and max: the extrema of bool, numeric and datetime columns
+
+    Every column is read once, and columns are profiled on n_jobs threads.
+    Distinct values are counted exactly unless approximate is set. Then the
+    distinct values of columns other than object columns are estimated with
+    HyperLogLog, which never builds a table of the distinct values. (Object
+    columns are always counted exactly, since hashing them costs more than
+    counting them.)
+    Columns whose flags depend on the exact count are recounted from the same
+    hashes. These are columns with few distinct values, and columns with no
+    nulls whose estimate is within three standard errors of the row count.
+
+    The helpers below take the profile as stats, so it only has to be computed
+    once. Without it they check just the columns and statistics they need.
+    """
+    def run(colname):
+        return _profile_column(df[colname], approximate)
+
+    workers = worker_count(n_jobs)
+    if workers > 1 and len(df.columns) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            rows = list(executor.map(run, df.columns))
+    else:
+        rows = [run(colname) for colname in df.columns]
+
+    return pd.DataFrame(rows, index=df.columns)
+
+
+def unique_columns(df, stats=None):
     """
     Returns a list of columns that have a unique value for every row.
+
+    stats is an optional dataframe returned by profile(df).
     """
-    colnames = []
-    for colname in df.columns:
-        if df[colname].nunique() == len(df):
-            colnames.append(colname)
+    if stats is None:
+        return [name for name in df.columns
+                if df[name].nunique() == len(df)]
 
-    return colnames
+    return _flagged(stats, 'unique')
 
 
-def binary_columns(df):
+def binary_columns(df, stats=None):
     """
     Returns a list of columns in the dataframe that only have two unique
     values.
     """
-    return [name for name in df.columns if len(pd.unique(df[name])) == 2]
+    if stats is None:
+        return [name for name in df.columns if len(pd.unique(df[name])) == 2]
+
+    return _flagged(stats, 'binary')
 
 
-def categorical_columns(df):
+def categorical_columns(df, stats=None):
     """
     Returns a list of columns that have string values and less than 100 unique
     values.
     """
-    return [name for name in df.columns
-            if df[name].dtype == np.object and len(pd.unique(df[name])) < 100]
+    if stats is None:
+        return [name for name in df.columns
+                if column_kind(df[name].dtype) == 'object'
+                and len(pd.unique(df[name])) < MAX_CATEGORIES]
 
+    return _flagged(stats, 'categorical')
 
-def missing_columns(df):
+
+def missing_columns(df, stats=None):
     """
     Returns a list of columns in the dataframe that include NaN or null values.
     """
-    total = len(df)
-    counts = df.count()
-    return [name for name in df.columns if counts[name] < total]
+    if stats is None:
+        total = len(df)
+        counts = df.count()
+        return [name for name in df.columns if counts[name] < total]
+
+    return list(stats.index[stats.missing > 0])
 
 
-def plot_missing(df, *colnames):
+def plot_missing(df, *colnames, stats=None):
     """
     Plots a bar chart comparing the number of present and missing values for
     the given columns.
+
+    The counts are read from stats (a dataframe returned by profile) if it is
+    given, and otherwise counted without copying the columns.
     """
+    if stats is None:
+        counts = {colname: df[colname].count() for colname in colnames}
+        missing = {colname: len(df) - counts[colname] for colname in colnames}
+    else:
+        counts, missing = stats['count'], stats['missing']
+
     fig = plt.figure(1, figsize=(9, 6))
 
     fig_columns = len(colnames) // 3 + 1;
     for i, colname in enumerate(colnames, start=1):
         plt.subplot(fig_columns, 3, i)
-        missing = df[colname][df[colname].isnull()]
-        present = df[colname][df[colname].notnull()]
         plt.title(colname)
-        plt.bar(['present', 'missing'], [len(present), len(missing)])
+        plt.bar(['present', 'missing'], [counts[colname], missing[colname]])
 
     plt.tight_layout()
     plt.show()
@@ -83,7 +145,122 @@ def plot_binary_predicate(df, col, true_name, false_name, predicate):
     Plots a bar chart showing the distribution of values between two classes,
     one where the predicate is true and one where the predicate is false.
     """
-    true_count = len(df[col][predicate(df[col])])
-    false_count = len(df[col][~predicate(df[col])])
+    true_count = np.count_nonzero(np.asarray(predicate(df[col]), dtype=bool))
+    false_count = len(df) - true_count
     plt.bar([true_name, false_name], [true_count, false_count])
     plt.show()
+
+
+def plot_distribution(data, colname, bins=50, sample_size=100000, seed=None):
+    """
+    Plots a histogram of the present values of a column.
+
+    data is a dataframe or an iterable of dataframe chunks, such as CsvChunks.
+    The histogram is drawn from a uniform random sample of at most sample_size
+    rows, so the whole column never has to be held in memory.
+    """
+    chunks = [data] if isinstance(data, pd.DataFrame) else data
+    reservoir = Reservoir(sample_size, seed)
+    for chunk in chunks:
+        reservoir.add(chunk[colname].values)
+
+    sample = pd.Series(reservoir.sample)
+    plt.hist(sample[sample.notnull()], bins=bins)
+    plt.title(colname)
+    plt.show()
+
+
+def column_kind(dtype):
+    """
+    Returns the kind of values a column with the dtype holds: one of bool,
+    numeric, datetime, category or object. Strings are object, whether they
+    are stored as objects or with a string dtype.
+    """
+    if pd.api.types.is_bool_dtype(dtype):
+        return 'bool'
+    elif pd.api.types.is_numeric_dtype(dtype):
+        return 'numeric'
+    elif pd.api.types.is_datetime64_any_dtype(dtype):
+        return 'datetime'
+    elif isinstance(dtype, pd.CategoricalDtype):
+        return 'category'
+    else:
+        return 'object'
+
+
+def _flagged(stats, flag):
+    return list(stats.index[stats[flag].astype(bool)])
+
+
+def _profile_column(series, approximate):
+    n = len(series)
+    present = series.notnull().values
+    count = int(present.sum())
+    values = series.values if count == n else series.values[present]
+    kind = column_kind(series.dtype)
+
+    if not approximate or kind == 'object':
+        distinct = _count_distinct(values)
+    else:
+        hashes = pd.util.hash_array(np.asarray(values))
+        distinct = _hyperloglog(hashes, HLL_PRECISION)
+        # Flags need the exact count near the cutoffs, which the hashes give
+        # without hashing the values again. Only columns without nulls can be
+        # unique.
+        error = 3 * 1.04 / np.sqrt(2 ** HLL_PRECISION) * n
+        if distinct < 2 * MAX_CATEGORIES \
+                or (count == n and abs(distinct - n) <= error):
+            distinct = _count_distinct(hashes)
+
+    # pd.unique counts null as a value of its own
+    with_null = distinct + (count < n)
+
+    low, high = None, None
+    if kind != 'object' and kind != 'category' and count > 0:
+        low, high = extrema(values)
+
+    return {
+        'kind': kind,
+        'count': count,
+        'missing': n - count,
+        'distinct': distinct,
+        'binary': with_null == 2,
+        'unique': distinct == n,
+        'categorical': kind == 'object' and with_null < MAX_CATEGORIES,
+        'min': low,
+        'max': high
+    }
+
+
+def _count_distinct(values):
+    return len(pd.unique(values))
+
+
+def _hyperloglog(hashes, p=HLL_PRECISION):
+    """
+    Returns the HyperLogLog estimate of the number of distinct 64 bit hashes,
+    using 2 ** p registers. The standard error is about 1.04 / sqrt(2 ** p).
+    """
+    m = 1 << p
+    if len(hashes) == 0:
+        return 0
+
+    # The first p bits pick a register, and the next 32 give the rank of the
+    # first set bit (frexp is exact on 32 bit integers)
+    registers = (hashes >> np.uint64(64 - p)).astype(np.intp)
+    rest = ((hashes << np.uint64(p)) >> np.uint64(32)).astype(np.float64)
+    ranks = 33 - np.frexp(rest)[1]
+
+    # Marks which ranks occur in each register, then takes the highest
+    seen = np.bincount(registers * 34 + ranks, minlength=m * 34) > 0
+    seen = seen.reshape(m, 34)[:, ::-1]
+    maxima = np.where(seen.any(axis=1), 33 - seen.argmax(axis=1), 0)
+
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / np.sum(2.0 ** -maxima)
+    zeros = np.count_nonzero(maxima == 0)
+    if estimate <= 2.5 * m and zeros > 0:
+        # Linear counting is more accurate for small cardinalities
+        estimate = m * np.log(m / zeros)
+
+    return int(round(estimate))
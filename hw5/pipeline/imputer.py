@@ -0,0 +1,124 @@
+import numpy as np
+import pandas as pd
+
+STRATEGIES = ['avg', 'mode']
+
+class Imputer:
+    """
+    Replaces null values with statistics fitted on training data, and adds a
+    column recording which rows were imputed.
+
+    strategies maps column names to 'avg' or 'mode'. values maps column names
+    to fixed values that are used instead of fitted ones.
+
+    partial_fit can be used to fit the statistics over a stream of chunks, and
+    imputers fitted on different chunks can be combined with merge. Averages
+    are kept as running counts and means, and modes as value counts.
+    """
+    def __init__(self, strategies, values=None):
+        for colname, how in strategies.items():
+            if how not in STRATEGIES:
+                raise Exception(f"\"how\" argument of \"{how}\" is not"
+                                f" supported.")
+
+        self.strategies = strategies
+        self.fixed = dict(values or {})
+        self.reset()
+
+
+    def reset(self):
+        self.counts = pd.Series(0, index=self._colnames('avg'), dtype=float)
+        self.means = pd.Series(0, index=self._colnames('avg'), dtype=float)
+        self.value_counts = {colname: pd.Series(dtype=float)
+                             for colname in self._colnames('mode')}
+
+
+    def fit(self, df):
+        self.reset()
+        self.partial_fit(df)
+        return self
+
+
+    def partial_fit(self, df):
+        avg_colnames = self._colnames('avg')
+        if avg_colnames:
+            # One pass over all the averaged columns at once
+            block = df[avg_colnames]
+            self._merge_moments(block.count().astype(float),
+                                block.mean().fillna(0))
+
+        for colname in self._colnames('mode'):
+            self.value_counts[colname] = \
+                self.value_counts[colname].add(df[colname].value_counts(),
+                                               fill_value=0)
+
+        return self
+
+
+    def merge(self, other):
+        """
+        Adds the statistics of another imputer with the same strategies, as if
+        this imputer had also been fitted on its data.
+        """
+        self._merge_moments(other.counts, other.means)
+        for colname, counts in other.value_counts.items():
+            self.value_counts[colname] = \
+                self.value_counts[colname].add(counts, fill_value=0)
+
+        return self
+
+
+    @property
+    def values(self):
+        """
+        Returns a dictionary of the value imputed for each column.
+        """
+        values = {}
+        for colname in self._colnames('avg'):
+            count = self.counts[colname]
+            values[colname] = self.means[colname] if count else np.nan
+
+        for colname, counts in self.value_counts.items():
+            # Like Series.mode, break ties with the smallest value
+            values[colname] = counts.sort_index().idxmax() \
+                if len(counts) else np.nan
+
+        values.update(self.fixed)
+        return values
+
+
+    def transform(self, df):
+        """
+        Returns a copy of the dataframe with the null values replaced.
+
+        Only the imputed columns are copied.
+        """
+        return df.assign(**self.columns(df))
+
+
+    def columns(self, df):
+        """
+        Returns a dictionary of the imputed columns and the columns recording
+        which rows were imputed.
+        """
+        columns = {}
+        for colname, value in self.values.items():
+            nulls = df[colname].isnull()
+            columns[colname] = df[colname].where(~nulls, value)
+            columns[colname + '_imputed'] = nulls.astype(float)
+
+        return columns
+
+
+    def _merge_moments(self, counts, means):
+        # Chan et al.'s update, which stays accurate when the counts differ a
+        # lot between chunks
+        total = self.counts + counts
+        weight = (counts / total).fillna(0)
+        self.means = self.means + (means - self.means) * weight
+        self.counts = total
+
+
+    def _colnames(self, how):
+        return [colname for colname, strategy in self.strategies.items()
+                if strategy == how and colname not in self.fixed]
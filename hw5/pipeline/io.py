@@ -3,15 +3,217 @@ This module handles the reading and writing of data in various formats.
 
 Methods in this module default to assuming that all data files are stored under
 a /data directory in the project root.
+
+CSV files are cached in Feather format under /data/.cache the first time they
+are read, so later reads skip parsing the CSV entirely.
 """
+import os
+import glob
+import hashlib
+import types
+import numpy as np
 import pandas as pd
+import pyarrow
 from datetime import datetime
 
+CACHE_DIR = '.cache/'
+
+class DatetimeConverter:
+    """
+    Parses a date string with a fixed format.
+
+    When passed to read_csv as a converter, the column is instead parsed all at
+    once with parse_datetimes.
+    """
+    def __init__(self, date_format):
+        self.date_format = date_format
+
+    def __call__(self, d):
+        return datetime.strptime(d, self.date_format)
+
 def datetime_converter(date_format):
-    return lambda d: datetime.strptime(d, date_format)
+    return DatetimeConverter(date_format)
+
+def parse_datetimes(series, date_format):
+    """
+    Parses a column of date strings with the given format.
+
+    Each distinct string is parsed only once, so the time taken is proportional
+    to the number of distinct dates rather than the number of rows.
+    """
+    codes, uniques = pd.factorize(series)
+    parsed = pd.to_datetime(uniques, format=date_format).values
+    values = np.full(len(codes), np.datetime64('NaT'), dtype=parsed.dtype)
+    present = codes >= 0
+    values[present] = parsed[codes[present]]
+    return pd.Series(values, index=series.index, name=series.name)
+
+def read_csv(filename, prefix='data/', cache=True, date_formats=None,
+             **kwargs):
+    """
+    Reads a CSV file into a dataframe.
+
+    Columns named in date_formats are parsed with parse_datetimes. Converters
+    made by datetime_converter are treated the same way, which keeps pandas on
+    its fast CSV parser.
+
+    Unless cache is False, the dataframe is also written to a Feather file.
+    Later reads with the same arguments load the Feather file instead, as long
+    as the CSV has not been modified since. Caches for other arguments are
+    kept, and caches of older versions of the CSV are removed. Dataframes that Feather cannot
+    store (e.g. object columns mixing numbers and strings) are not cached.
+    Chunked reads are never cached, and return an iterator over parsed chunks
+    when date_formats are used.
+    """
+    path = prefix + filename
+    kwargs, date_formats = _extract_date_formats(kwargs, date_formats)
+
+    if not cache or 'chunksize' in kwargs or kwargs.get('iterator'):
+        reader = pd.read_csv(path, **kwargs)
+        if not date_formats:
+            return reader
+        elif isinstance(reader, pd.DataFrame):
+            return _parse_date_columns(reader, date_formats)
+        else:
+            return (_parse_date_columns(chunk, date_formats)
+                    for chunk in reader)
+
+    stamp = _cache_stamp(path)
+    key = _cache_key(kwargs, date_formats)
+    cache_path = _cache_path(prefix, filename, stamp, key)
+    if os.path.exists(cache_path):
+        return pd.read_feather(cache_path)
+
+    df = _parse_date_columns(pd.read_csv(path, **kwargs), date_formats)
+    if isinstance(df.index, pd.RangeIndex) and df.index.start == 0:
+        _write_cache(df, prefix, filename, stamp, cache_path)
+
+    return df
+
+class CsvChunks:
+    """
+    A stream of dataframe chunks read from a CSV file.
+
+    Unlike the reader returned by read_csv, it can be iterated over more than
+    once; each iteration reads the file again.
+    """
+    def __init__(self, filename, chunksize, prefix='data/', **kwargs):
+        self.filename = filename
+        self.chunksize = chunksize
+        self.prefix = prefix
+        self.kwargs = kwargs
+
+    def __iter__(self):
+        return iter(read_csv(self.filename,
+                             self.prefix,
+                             chunksize=self.chunksize,
+                             **self.kwargs))
+
+def write_csv(df, filename, prefix='data/', append=False):
+    """
+    Writes a dataframe to a CSV file.
+
+    If append is set, the rows are added to the end of the file, and a header
+    is only written if the file does not exist yet.
+    """
+    path = prefix + filename
+    if append:
+        df.to_csv(path, mode='a', header=not os.path.exists(path), index=False)
+    else:
+        df.to_csv(path, index=False)
+
+def _cache_path(prefix, filename, stamp, key):
+    return f"{prefix}{CACHE_DIR}{filename}.{stamp}.{key}.feather"
+
+def _write_cache(df, prefix, filename, stamp, cache_path):
+    os.makedirs(prefix + CACHE_DIR, exist_ok=True)
+
+    # Written under a temporary name first, so a failed write never leaves a
+    # broken cache file behind
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        df.to_feather(tmp_path)
+    except pyarrow.ArrowException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return
+
+    # Caches of an older version of the CSV can never be read again
+    current = glob.glob(_cache_path(prefix, filename, stamp, '*'))
+    for old_path in glob.glob(_cache_path(prefix, filename, '*', '*')):
+        if old_path not in current:
+            os.remove(old_path)
+
+    os.replace(tmp_path, cache_path)
+
+def _extract_date_formats(kwargs, date_formats):
+    date_formats = dict(date_formats or {})
+    converters = dict(kwargs.get('converters') or {})
+    for colname, converter in list(converters.items()):
+        if isinstance(converter, DatetimeConverter):
+            date_formats[colname] = converter.date_format
+            del converters[colname]
+
+    kwargs = dict(kwargs)
+    if converters:
+        kwargs['converters'] = converters
+    else:
+        kwargs.pop('converters', None)
+
+    if date_formats:
+        dtype = dict(kwargs.get('dtype') or {})
+        dtype.update({colname: str for colname in date_formats})
+        kwargs['dtype'] = dtype
+
+    return kwargs, date_formats
+
+def _parse_date_columns(df, date_formats):
+    for colname, date_format in date_formats.items():
+        df[colname] = parse_datetimes(df[colname], date_format)
+
+    return df
+
+def _cache_stamp(path):
+    # Changes whenever the CSV is modified
+    stat = os.stat(path)
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+def _cache_key(kwargs, date_formats):
+    description = repr((_token(kwargs), _token(date_formats)))
+    return hashlib.sha256(description.encode()).hexdigest()[:16]
+
+def _token(value):
+    """
+    Returns a description of a read_csv argument that is stable across runs.
+
+    Functions are described by name, by their code and by the values they
+    close over, so that e.g. converters for different date formats, or two
+    different lambdas, get different tokens.
+    """
+    if isinstance(value, dict):
+        return sorted((key, _token(v)) for key, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        return [_token(v) for v in value]
+    elif callable(value):
+        closure = [_token(cell.cell_contents)
+                   for cell in getattr(value, '__closure__', None) or []]
+        name = getattr(value, '__qualname__', type(value).__qualname__)
+        code = getattr(value, '__code__', None)
+        state = getattr(value, '__dict__', None)
+        if isinstance(value, type) or not isinstance(state, dict):
+            state = {}
 
-def read_csv(filename, prefix='data/', **kwargs):
-    return pd.read_csv(prefix + filename, **kwargs)
+        return (getattr(value, '__module__', None),
+                name,
+                closure,
+                _code_token(code) if code else None,
+                _token(getattr(value, '__defaults__', None)),
+                _token(state))
+    else:
+        return repr(value)
 
-def write_csv(df, filename, prefix='data/'):
-    df.to_csv(prefix + filename, index=False)
+def _code_token(code):
+    consts = [_code_token(const) if isinstance(const, types.CodeType)
+              else repr(const)
+              for const in code.co_consts]
+    return (code.co_code, consts, code.co_names)
@@ -1,9 +1,13 @@
 """
 This module contains helper methods that wrap sklearn prediction models.
 """
+import os
+import tempfile
+import joblib
+import numpy as np
 import pandas as pd
 from sklearn.dummy import DummyClassifier
-from sklearn.linear_model import LogisticRegression
+from sklearn.linear_model import LogisticRegression, SGDClassifier
 from sklearn.tree import DecisionTreeClassifier
 from sklearn.neighbors import KNeighborsClassifier
 from sklearn.svm import LinearSVC
@@ -11,102 +15,148 @@ from sklearn.ensemble import RandomForestClassifier, BaggingClassifier, \
                              AdaBoostClassifier
 from sklearn.preprocessing import StandardScaler
 from sklearn.pipeline import Pipeline
+from sklearn.base import clone
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from .result import PredictionResult, ResultCollection
-from .util import wrap_list
+from .store import data_hash
+from .util import wrap_list, worker_count, feature_matrix
+
+METHODS = [
+    'dummy',
+    'logistic_regression',
+    'decision_tree',
+    'k_nearest',
+    'linear_svm',
+    'forest',
+    'bagging',
+    'boosting'
+]
+
+def _fit_model(model, X, y):
+    # Module-level so that it can be pickled and sent to worker processes
+    model.fit(X, y)
+    return model
+
+def _fit_shared(model, filename):
+    # Runs in a worker process. The training data is memory-mapped, so every
+    # worker reads the same copy.
+    X, y = joblib.load(filename, mmap_mode='r')
+    return _fit_model(model, X, y)
+
+def _score(model, X, batch_size=None, n_threads=None):
+    """
+    Scores X in batches of batch_size rows, writing into one preallocated
+    array.
+
+    Dummy models are always scored in one call. A stratified dummy reseeds
+    its generator on every call, so batches would all replay the start of
+    the same random stream.
+    """
+    if isinstance(model, DummyClassifier):
+        batch_size = None
+
+    y_score = np.empty(X.shape[0])
+    batch_size = batch_size or max(X.shape[0], 1)
+    batches = [slice(start, start + batch_size)
+               for start in range(0, X.shape[0], batch_size)]
+
+    def score_batch(batch):
+        if hasattr(model, 'predict_proba'):
+            y_score[batch] = model.predict_proba(X[batch])[:,1]
+        else:
+            # SVMs only have a decision function
+            y_score[batch] = model.decision_function(X[batch])
+
+    workers = worker_count(n_threads)
+    if workers > 1 and len(batches) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(score_batch, batches))
+    else:
+        for batch in batches:
+            score_batch(batch)
+
+    return y_score
+
+def _score_shared(model, filename, batch_size=None):
+    # Runs in a worker process. The test matrix is memory-mapped, so every
+    # worker reads the same copy.
+    X = joblib.load(filename, mmap_mode='r')
+    return _score(model, X, batch_size)
+
 
 class Trainer:
     """
     Provides model training methods for a particular set of training data.
+
+    If n_jobs is given, every model fit is run as a separate task in a process
+    pool. Models are seeded before they are scheduled, so parallel training
+    returns the same models as serial training.
+
+    If sparse is set, models are trained on sparse CSR matrices. Columns
+    stored as sparse in the dataframes are never densified.
+
+    The X and y matrices for each split are built once, with the given dtype,
+    and reused for every model.
+
+    If a ModelStore is given, models already fitted to the same data with the
+    same parameters are loaded from the store instead of being fitted again.
+
+    A training set can also be a re-iterable stream of dataframe chunks, such
+    as CsvChunks. Only the sgd_ methods can train on those.
     """
-    def __init__(self, *dfs, label_colname=None, seed=None):
+    def __init__(self, *dfs, label_colname=None, seed=None, n_jobs=None,
+                 sparse=False, dtype=np.float64, store=None):
         self.dfs = dfs
         self.label_colname = label_colname
         self.seed = seed
+        self.n_jobs = n_jobs
+        self.sparse = sparse
+        self.dtype = dtype
+        self.store = store
+        self._data = {}
+        self._data_hashes = {}
 
 
     def dummy(self):
         """
         Returns dummy classifier models using the 'stratified' technique.
         """
-        models = []
-        for X, y in self._training_data():
-            model = DummyClassifier(random_state=self.seed)
-            model.fit(X, y)
-            models.append(model)
-
-        return models if len(models) > 1 else models[0]
+        return self._fit(self._dummy_model())
 
 
     def logistic_regression(self, c=1):
         """
         Returns logistic regression models fitted to the training data.
         """
-        models = []
-        for X, y in self._training_data():
-            model = LogisticRegression(solver='liblinear',
-                                       C=c,
-                                       random_state=self.seed)
-            model.fit(X, y)
-            models.append(model)
-
-        return models if len(models) > 1 else models[0]
+        return self._fit(self._logistic_regression_model(c=c))
 
 
     def decision_tree(self, max_depth=None):
         """
         Returns decision tree models fitted to the training data.
         """
-        models = []
-        for X, y in self._training_data():
-            model = DecisionTreeClassifier(max_depth=max_depth,
-                                           random_state=self.seed)
-            model.fit(X, y)
-            models.append(model)
-
-        return models if len(models) > 1 else models[0]
+        return self._fit(self._decision_tree_model(max_depth=max_depth))
 
 
     def k_nearest(self, k=5):
         """
         Returns k-nearest neighbors models fitted to the training data.
         """
-        models = []
-        for X, y in self._training_data():
-            model = KNeighborsClassifier(n_neighbors=k)
-            model.fit(X, y)
-            models.append(model)
-
-        return models if len(models) > 1 else models[0]
+        return self._fit(self._k_nearest_model(k=k))
 
 
     def linear_svm(self, c=1):
         """
         Returns linear svm models fitted to the training data.
         """
-        models = []
-        for X, y in self._training_data():
-            # Prefer dual=False when n_samples > n_features
-            model = Pipeline([('scale', StandardScaler()),
-                              ('svm', LinearSVC(C=c, dual=False,
-                                                random_state=self.seed))])
-            model.fit(X, y)
-            models.append(model)
-
-        return models if len(models) > 1 else models[0]
+        return self._fit(self._linear_svm_model(c=c))
 
 
     def forest(self, n_trees=10):
         """
         Returns random forest models fitted to the training data.
         """
-        models = []
-        for X, y in self._training_data():
-            model = RandomForestClassifier(n_estimators=n_trees,
-                                           random_state=self.seed)
-            model.fit(X, y)
-            models.append(model)
-
-        return models if len(models) > 1 else models[0]
+        return self._fit(self._forest_model(n_trees=n_trees))
 
 
     def bagging(self, n_estimators=10):
@@ -115,14 +165,7 @@ class Trainer:
 
         Underlying base estimator is a decision tree.
         """
-        models = []
-        for X, y in self._training_data():
-            model = BaggingClassifier(n_estimators=n_estimators,
-                                      random_state=self.seed)
-            model.fit(X, y)
-            models.append(model)
-
-        return models if len(models) > 1 else models[0]
+        return self._fit(self._bagging_model(n_estimators=n_estimators))
 
 
     def boosting(self, n_estimators=10):
@@ -131,14 +174,35 @@ class Trainer:
 
         Underlying base estimator is a decision tree.
         """
-        models = []
-        for X, y in self._training_data():
-            model = AdaBoostClassifier(n_estimators=n_estimators,
-                                       random_state=self.seed)
-            model.fit(X, y)
-            models.append(model)
+        return self._fit(self._boosting_model(n_estimators=n_estimators))
 
-        return models if len(models) > 1 else models[0]
+
+    def sgd_logistic_regression(self, alpha=0.0001, n_epochs=5):
+        """
+        Returns logistic regression models trained incrementally with
+        stochastic gradient descent.
+
+        Works on training splits that are streams of chunks, such as CsvChunks,
+        so a split never has to fit in memory.
+        """
+        model = SGDClassifier(loss='log',
+                              alpha=alpha,
+                              random_state=self.seed)
+        return self._fit_incremental(model, 'sgd', n_epochs)
+
+
+    def sgd_linear_svm(self, alpha=0.0001, n_epochs=5):
+        """
+        Returns linear svm models trained incrementally with stochastic
+        gradient descent.
+
+        Works on training splits that are streams of chunks, such as CsvChunks,
+        so a split never has to fit in memory.
+        """
+        model = SGDClassifier(loss='hinge',
+                              alpha=alpha,
+                              random_state=self.seed)
+        return self._fit_incremental(model, 'svm', n_epochs)
 
 
     def train_all(self, parameters={}, exclude=[]):
@@ -146,44 +210,218 @@ class Trainer:
         Train all the things.
 
         Returns a dictionary with method names as keys and models as values.
+        All fits are scheduled together, so with n_jobs set every method and
+        split trains concurrently.
         """
-        methods = {
-            'dummy': self.dummy,
-            'logistic_regression': self.logistic_regression,
-            'decision_tree': self.decision_tree,
-            'k_nearest': self.k_nearest,
-            'linear_svm': self.linear_svm,
-            'forest': self.forest,
-            'bagging': self.bagging,
-            'boosting': self.boosting
-        }
+        names = [name for name in METHODS if name not in exclude]
+        unfitted = [self.model(name, **(parameters.get(name) or {}))
+                    for name in names]
 
         models = dict()
+        for name, fitted in zip(names, self._fit_many(unfitted)):
+            models[name] = fitted if len(fitted) > 1 else fitted[0]
 
-        for name, func in methods.items():
-            if name in exclude:
-                next
+        return models
 
-            params = parameters.get(name) or {}
-            models[name] = func(**params)
 
-        return models
+    def model(self, name, **params):
+        """
+        Returns an unfitted model for the named training method.
+        """
+        if name not in METHODS:
+            raise Exception(f"Unknown training method \"{name}\".")
+
+        return getattr(self, f"_{name}_model")(**params)
+
+
+    def _dummy_model(self):
+        return DummyClassifier(strategy='stratified', random_state=self.seed)
+
+
+    def _logistic_regression_model(self, c=1):
+        return LogisticRegression(solver='liblinear',
+                                  C=c,
+                                  random_state=self.seed)
+
+
+    def _decision_tree_model(self, max_depth=None):
+        return DecisionTreeClassifier(max_depth=max_depth,
+                                      random_state=self.seed)
+
+
+    def _k_nearest_model(self, k=5):
+        return KNeighborsClassifier(n_neighbors=k)
+
+
+    def _linear_svm_model(self, c=1):
+        # Prefer dual=False when n_samples > n_features. Centering would
+        # densify sparse input, so only scale it.
+        return Pipeline([('scale', StandardScaler(with_mean=not self.sparse)),
+                         ('svm', LinearSVC(C=c, dual=False,
+                                           random_state=self.seed))])
+
+
+    def _forest_model(self, n_trees=10):
+        return RandomForestClassifier(n_estimators=n_trees,
+                                      random_state=self.seed)
 
 
-    def _training_data(self):
-        for df in self.dfs:
-            X = df.drop(columns=[self.label_colname]).values
-            y = df[self.label_colname].values
-            yield X, y
+    def _bagging_model(self, n_estimators=10):
+        return BaggingClassifier(n_estimators=n_estimators,
+                                 random_state=self.seed)
+
+
+    def _boosting_model(self, n_estimators=10):
+        return AdaBoostClassifier(n_estimators=n_estimators,
+                                  random_state=self.seed)
+
+
+    def _fit(self, model):
+        models = self._fit_many([model])[0]
+        return models if len(models) > 1 else models[0]
+
+
+    def _fit_many(self, models, splits=None):
+        """
+        Fits a fresh copy of each model to every training split, or only to the
+        splits with the given indices.
+
+        Returns a list with one list of fitted models (one per split) for each
+        model given.
+        """
+        splits = range(len(self.dfs)) if splits is None else splits
+        tasks = [(model, split) for model in models for split in splits]
+
+        if self.store:
+            keys = [self.store.key(model, self._data_hash(split))
+                    for model, split in tasks]
+            fitted = [self.store.get(key) for key in keys]
+        else:
+            fitted = [None] * len(tasks)
+
+        pending = [i for i, model in enumerate(fitted) if model is None]
+        unfitted = [clone(tasks[i][0]) for i in pending]
+        pending_splits = [tasks[i][1] for i in pending]
+
+        workers = worker_count(self.n_jobs)
+        if workers > 1 and len(pending) > 1:
+            # Each split is dumped once and memory-mapped by the workers,
+            # rather than pickled into every task
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                filenames = {}
+                for split in set(pending_splits):
+                    filenames[split] = os.path.join(tmp_dir, f"data_{split}")
+                    joblib.dump(self._split_data(split), filenames[split])
+
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    newly_fitted = list(executor.map(
+                        _fit_shared,
+                        unfitted,
+                        [filenames[split] for split in pending_splits]))
+        else:
+            newly_fitted = [_fit_model(model, *self._split_data(split))
+                            for model, split in zip(unfitted, pending_splits)]
+
+        for i, model in zip(pending, newly_fitted):
+            fitted[i] = model
+            if self.store:
+                self.store.put(keys[i], model)
+
+        n = len(splits)
+        return [fitted[i:i + n] for i in range(0, len(fitted), n)]
+
+
+    def _split_data(self, split):
+        if split not in self._data:
+            df = self.dfs[split]
+            if not isinstance(df, pd.DataFrame):
+                raise Exception(f"Training set {split} is a stream of chunks;"
+                                f" only sgd_ methods can train on it.")
+
+            X = feature_matrix(df, self.label_colname, self.sparse, self.dtype)
+            y = df[self.label_colname].to_numpy(dtype=self.dtype)
+            self._data[split] = (X, y)
+
+        return self._data[split]
+
+
+    def _fit_incremental(self, model, step_name, n_epochs):
+        """
+        Fits a fresh copy of an SGD model to each split, one chunk at a time.
+
+        The first pass over a split fits the scaler, and every later pass is an
+        epoch of SGD over the scaled chunks.
+        """
+        models = []
+        for split in range(len(self.dfs)):
+            rand = np.random.RandomState(self.seed)
+            scaler = StandardScaler(with_mean=not self.sparse)
+            sgd = clone(model)
+
+            for X, _ in self._chunk_data(split):
+                scaler.partial_fit(X)
+
+            for _ in range(n_epochs):
+                for X, y in self._chunk_data(split):
+                    # SGD expects shuffled samples
+                    order = rand.permutation(X.shape[0])
+                    sgd.partial_fit(scaler.transform(X[order]), y[order],
+                                    classes=[0.0, 1.0])
+
+            models.append(Pipeline([('scale', scaler), (step_name, sgd)]))
+
+        return models if len(models) > 1 else models[0]
+
+
+    def _chunk_data(self, split):
+        chunks = self.dfs[split]
+        if isinstance(chunks, pd.DataFrame):
+            yield self._split_data(split)
+        else:
+            for df in chunks:
+                X = feature_matrix(df, self.label_colname, self.sparse,
+                                   self.dtype)
+                y = df[self.label_colname].to_numpy(dtype=self.dtype)
+                yield X, y
+
+
+    def _data_hash(self, split):
+        if split not in self._data_hashes:
+            self._data_hashes[split] = data_hash(*self._split_data(split))
+
+        return self._data_hashes[split]
 
 
 class Tester:
     """
     Provides test methods for a particular set of test data.
+
+    If sparse is set, models are tested on sparse CSR matrices.
+
+    The X and y matrices for each split are built once, with the given dtype,
+    and reused for every model.
+
+    If batch_size is given, models score the test data in batches of that many
+    rows, optionally using n_threads threads. Scores are written into a
+    preallocated array. Dummy models, whose random scores depend on how they
+    are called, are always scored in one call.
+
+    If n_jobs is given, evaluate and evaluate_splits score models concurrently
+    in a pool of threads or, with backend='process', of processes. Worker
+    processes share one memory-mapped copy of each test matrix.
     """
-    def __init__(self, *dfs, label_colname=None):
+    def __init__(self, *dfs, label_colname=None, sparse=False,
+                 dtype=np.float64, batch_size=None, n_threads=None,
+                 n_jobs=None, backend='thread'):
         self.dfs = dfs
         self.label_colname = label_colname
+        self.sparse = sparse
+        self.dtype = dtype
+        self.batch_size = batch_size
+        self.n_threads = n_threads
+        self.n_jobs = n_jobs
+        self.backend = backend
+        self._data = {}
 
 
     def test(self, *models, threshold=None):
@@ -205,20 +443,8 @@ class Tester:
             raise Exception(f"Number of models ({len(models)}) does not match"
                             f" test sets ({len(self.dfs)}).")
 
-        results = []
-        for (X, y_actual), model in zip(self._test_data(), models):
-            if isinstance(model, Pipeline) and \
-               isinstance(model.named_steps.svm, LinearSVC):
-                y_score = model.decision_function(X)
-            else:
-                y_score = model.predict_proba(X)[:,1]
-
-            y_predict = model.predict(X) # ONLY USED IF THRESHOLD NOT GIVEN!
-            df_results = pd.DataFrame({ 'actual': y_actual,
-                                        'score': y_score,
-                                        'predict': y_predict },
-                                      dtype=float)
-            results.append(PredictionResult(df_results))
+        results = [self._test_model(model, X, y_actual)
+                   for (X, y_actual), model in zip(self._test_data(), models)]
 
         if threshold:
             results = [r.with_threshold(threshold) for r in results]
@@ -226,40 +452,131 @@ class Tester:
         return results
 
 
-    def evaluate(self, model_dict, thresholds=None):
+    def evaluate(self, model_dict, thresholds=None, n_resamples=None,
+                 alpha=0.05, seed=None):
         """
         Tests lots of different models at different thresholds.
+
+        If n_resamples is given, the metrics at each threshold come with
+        bootstrap confidence intervals.
         """
-        collection = ResultCollection()
-        for name, model in model_dict.items():
-            result = self._test(model)[0] # Hack for now
+        if len(self.dfs) != 1:
+            raise Exception(f"evaluate needs exactly one test set, not"
+                            f" {len(self.dfs)}.")
 
+        tasks = [(model, 0) for model in model_dict.values()]
+        results = self._test_many(tasks)
+
+        named = {}
+        for name, result in zip(model_dict, results):
             if thresholds:
-                results = result.with_thresholds(thresholds)
-                this_collection = ResultCollection.from_stack(results,
-                                                              index=thresholds)
-                collection.join(name, this_collection)
+                named[name] = ResultCollection.from_thresholds(
+                    result, thresholds, n_resamples, alpha, seed, self.n_jobs)
             else:
-                collection.join(name, result)
+                named[name] = result
 
-        return collection
+        return ResultCollection.from_named(named)
 
 
-    def evaluate_splits(self, model_dict, threshold=None):
+    def evaluate_splits(self, model_dict, threshold=None, n_resamples=None,
+                        alpha=0.05, seed=None):
         """
         Tests lots of different models over different splits.
+
+        If n_resamples is given along with a threshold, each split's metrics
+        come with bootstrap confidence intervals.
         """
-        collection = ResultCollection()
-        for name, models in model_dict.items():
-            results = self._test(*models, threshold=threshold)
-            this_collection = ResultCollection.from_stack(results)
-            collection.join(name, this_collection)
+        tasks = []
+        for models in model_dict.values():
+            if len(models) != len(self.dfs):
+                raise Exception(f"Number of models ({len(models)}) does not"
+                                f" match test sets ({len(self.dfs)}).")
+
+            tasks.extend((model, split) for split, model in enumerate(models))
+
+        results = self._test_many(tasks)
+        if threshold:
+            results = [r.with_threshold(threshold) for r in results]
 
-        return collection
+        n = len(self.dfs)
+        named = {}
+        for i, name in enumerate(model_dict):
+            named[name] = ResultCollection.from_stack(results[i * n:i * n + n],
+                                                      n_resamples=n_resamples,
+                                                      alpha=alpha, seed=seed)
+
+        return ResultCollection.from_named(named)
+
+
+    def _test_many(self, tasks):
+        """
+        Tests each (model, split) pair, concurrently if n_jobs is set.
+
+        Returns a list of results in the same order as the tasks.
+        """
+        workers = worker_count(self.n_jobs)
+        if workers <= 1 or len(tasks) <= 1:
+            return [self._test_model(model, *self._split_data(split))
+                    for model, split in tasks]
+
+        # Build the shared test matrices before any workers start
+        for split in {split for _, split in tasks}:
+            self._split_data(split)
+
+        models = [model for model, _ in tasks]
+        if self.backend == 'process':
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                filenames = {}
+                for split in {split for _, split in tasks}:
+                    filenames[split] = os.path.join(tmp_dir, f"X_{split}")
+                    joblib.dump(self._split_data(split)[0], filenames[split])
+
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    scores = list(executor.map(
+                        _score_shared,
+                        models,
+                        [filenames[split] for _, split in tasks],
+                        [self.batch_size] * len(tasks)))
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                scores = list(executor.map(
+                    lambda task: self._score(task[0], task[1]), tasks))
+
+        return [self._result(model, self._split_data(split)[1], y_score)
+                for (model, split), y_score in zip(tasks, scores)]
+
+
+    def _test_model(self, model, X, y_actual):
+        y_score = _score(model, X, self.batch_size, self.n_threads)
+        return self._result(model, y_actual, y_score)
+
+
+    def _score(self, model, split):
+        X, _ = self._split_data(split)
+        return _score(model, X, self.batch_size, self.n_threads)
+
+
+    def _result(self, model, y_actual, y_score):
+        # ONLY USED IF THRESHOLD NOT GIVEN! Binary classifiers predict the
+        # positive class when its probability is over 0.5 or, for SVMs, when
+        # the decision function is positive.
+        probabilities = hasattr(model, 'predict_proba')
+        cutoff = 0.5 if probabilities else 0.0
+        y_predict = (y_score > cutoff).astype(float)
+
+        return PredictionResult.from_arrays(y_actual, y_score, y_predict,
+                                            probabilities=probabilities)
 
 
     def _test_data(self):
-        for df in self.dfs:
-            X = df.drop(columns=[self.label_colname]).values
-            y_actual = df[self.label_colname].values
-            yield X, y_actual
+        return [self._split_data(i) for i in range(len(self.dfs))]
+
+
+    def _split_data(self, split):
+        if split not in self._data:
+            df = self.dfs[split]
+            X = feature_matrix(df, self.label_colname, self.sparse, self.dtype)
+            y_actual = df[self.label_colname].to_numpy(dtype=self.dtype)
+            self._data[split] = (X, y_actual)
+
+        return self._data[split]
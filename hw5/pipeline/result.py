@@ -1,6 +1,13 @@
+import copy
+import numpy as np
+import pandas as pd
 from pandas import DataFrame, Series
 import sklearn.metrics as metrics
 import matplotlib.pyplot as plt
+from concurrent.futures import ThreadPoolExecutor
+from .util import worker_count
+
+THRESHOLD_METRICS = ['accuracy', 'precision', 'recall', 'f1', 'auc']
 
 class PredictionResult:
     """
@@ -11,15 +18,43 @@ class PredictionResult:
     - score
     - predict
 
-    Threshold should be a percentage.
+    The columns are sorted by score once and stored as read-only arrays.
+    Results with a different threshold share those arrays.
+
+    Threshold should be a percentage. probabilities should be False if the
+    scores are not probabilities (e.g. SVM decision values).
     """
-    def __init__(self, df, threshold=None):
-        self.df = df.sort_values('score', ascending=False)
+    def __init__(self, df, threshold=None, probabilities=True):
+        self._sort(df.actual.values, df.score.values, df.predict.values)
         self.threshold = threshold
+        self.probabilities = probabilities
+
+
+    @property
+    def df(self):
+        """Returns the results as a dataframe sorted by score."""
+        return DataFrame({ 'actual': self.actual,
+                           'score': self.score,
+                           'predict': self.predict })
 
 
     def with_threshold(self, threshold):
-        return PredictionResult(self.df, threshold)
+        result = copy.copy(self)
+        result.threshold = threshold
+        return result
+
+
+    def from_arrays(actual, score, predict, threshold=None,
+                    probabilities=True):
+        """
+        Returns a PredictionResult for the given arrays without building a
+        dataframe first.
+        """
+        result = PredictionResult.__new__(PredictionResult)
+        result._sort(actual, score, predict)
+        result.threshold = threshold
+        result.probabilities = probabilities
+        return result
 
 
     def with_thresholds(self, thresholds):
@@ -28,117 +63,318 @@ class PredictionResult:
 
     def baseline(self):
         """Returns the ratio of actually true outcomes to total outcomes."""
-        count_true = len(self.df[self.df.actual == 1])
-        return count_true / len(self.df)
+        return np.count_nonzero(self.actual == 1) / len(self.actual)
 
 
     def accuracy(self):
         if self.threshold:
-            return metrics.accuracy_score(self.df.actual.values,
-                                          self._threshold_predict())
+            return self._at_threshold('accuracy')
         else:
-            return metrics.accuracy_score(self.df.actual.values,
-                                          self.df.predict.values)
+            return metrics.accuracy_score(self.actual, self.predict)
 
 
     def precision(self):
         if self.threshold:
-            return metrics.precision_score(self.df.actual.values,
-                                           self._threshold_predict())
+            return self._at_threshold('precision')
         else:
-            return metrics.precision_score(self.df.actual.values,
-                                           self.df.predict.values)
+            return metrics.precision_score(self.actual, self.predict)
 
 
     def recall(self):
         if self.threshold:
-            return metrics.recall_score(self.df.actual.values,
-                                        self._threshold_predict())
+            return self._at_threshold('recall')
         else:
-            return metrics.recall_score(self.df.actual.values,
-                                        self.df.predict.values)
+            return metrics.recall_score(self.actual, self.predict)
 
 
     def f1(self):
         if self.threshold:
-            return metrics.f1_score(self.df.actual.values,
-                                    self._threshold_predict())
+            return self._at_threshold('f1')
         else:
-            return metrics.f1_score(self.df.actual.values,
-                                    self.df.predict.values)
+            return metrics.f1_score(self.actual, self.predict)
 
 
     def auc(self):
+        """
+        Returns the AUC of the hard predictions at the threshold. See roc_auc
+        for the AUC of the scores.
+        """
         if self.threshold:
-            return metrics.roc_auc_score(self.df.actual.values,
-                                         self._threshold_predict())
+            return self._at_threshold('auc')
         else:
-            return metrics.roc_auc_score(self.df.actual.values,
-                                         self.df.predict.values)
+            return metrics.roc_auc_score(self.actual, self.predict)
 
 
     def matrix(self):
-        m = metrics.confusion_matrix(self.df.actual.values,
-                                     self.df.predict.values)
+        m = metrics.confusion_matrix(self.actual, self.predict)
         return DataFrame(m,
                          index=['false', 'true'],
                          columns=['negative', 'positive'])
 
 
+    def roc_auc(self):
+        """
+        Returns the area under the ROC curve of the scores.
+
+        Unlike auc, this does not depend on the threshold. Tied scores are
+        treated as a single point on the curve, as in sklearn.
+        """
+        fpr, tpr = self._roc_points()
+        return np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2)
+
+
+    def average_precision(self):
+        """
+        Returns the average precision of the scores, as in sklearn.
+        """
+        tp, fp = self._group_counts()
+        recall = np.concatenate(([0], tp / tp[-1]))
+        precision = tp / (tp + fp)
+        return np.sum(np.diff(recall) * precision)
+
+
+    def log_loss(self, eps=1e-15):
+        """
+        Returns the log loss of the scores, or NaN if the scores are not
+        probabilities (e.g. SVM decision values).
+        """
+        if not self.probabilities:
+            return np.nan
+
+        p = np.clip(self.score, eps, 1 - eps)
+        return -np.mean(self.actual * np.log(p) +
+                        (1 - self.actual) * np.log(1 - p))
+
+
     def as_series(self):
+        if self.threshold:
+            series = self.metrics_at([self.threshold]).iloc[0].rename(None)
+        else:
+            series = Series({
+                'accuracy': self.accuracy(),
+                'precision': self.precision(),
+                'recall': self.recall(),
+                'f1': self.f1(),
+                'auc': self.auc()
+            })
+
+        return pd.concat([series, self.ranking_metrics()])
+
+
+    def ranking_metrics(self):
+        """
+        Returns the metrics that rank by score rather than use a threshold.
+        """
         return Series({
-            'accuracy': self.accuracy(),
-            'precision': self.precision(),
-            'recall': self.recall(),
-            'f1': self.f1(),
-            'auc': self.auc()
+            'roc_auc': self.roc_auc(),
+            'average_precision': self.average_precision(),
+            'log_loss': self.log_loss()
         })
 
 
-    def _threshold_predict(self):
-        # Stolen from Rayid Ghani
-        cutoff_index = int(len(self.df) * (self.threshold / 100.0))
-        return [1 if i < cutoff_index else 0 for i in range(len(self.df))]
+    def metrics_at(self, thresholds):
+        """
+        Returns a dataframe with one row of metrics for each threshold.
+
+        Every threshold is computed from a single cumulative sum over the
+        actual values in score order, rather than by building a prediction
+        for each threshold.
+        """
+        cum_true = np.concatenate(([0], np.cumsum(self.actual)))
+        cutoffs = self._cutoffs(thresholds)
+        metrics = _threshold_metrics(cum_true[cutoffs], cutoffs,
+                                     cum_true[-1], len(self.actual))
+        return DataFrame(dict(zip(THRESHOLD_METRICS, metrics)),
+                         index=list(thresholds))
+
+
+    def bootstrap(self, thresholds, n_resamples=1000, alpha=0.05, seed=None,
+                  n_jobs=None, batch_size=100):
+        """
+        Returns a dataframe like metrics_at with (1 - alpha) bootstrap
+        confidence intervals in extra columns suffixed _lower and _upper.
+
+        Resamples are drawn in batches, each an index matrix over the sorted
+        results that is scored with a few array operations. Batches run on
+        n_jobs threads.
+        """
+        cutoffs = self._cutoffs(thresholds)
+        sizes = [min(batch_size, n_resamples - start)
+                 for start in range(0, n_resamples, batch_size)]
+        seeds = np.random.RandomState(seed).randint(2**31 - 1, size=len(sizes))
+
+        def run_batch(args):
+            return _bootstrap_batch(self.actual, cutoffs, *args)
+
+        workers = worker_count(n_jobs)
+        if workers > 1 and len(sizes) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                batches = list(executor.map(run_batch, zip(sizes, seeds)))
+        else:
+            batches = [run_batch(args) for args in zip(sizes, seeds)]
+
+        # Shape is (resample, metric, threshold)
+        samples = np.concatenate(batches)
+        lower = np.percentile(samples, 100 * alpha / 2, axis=0)
+        upper = np.percentile(samples, 100 * (1 - alpha / 2), axis=0)
+
+        df = self.metrics_at(thresholds)
+        columns = {}
+        for i, name in enumerate(THRESHOLD_METRICS):
+            columns[name] = df[name].values
+            columns[name + '_lower'] = lower[i]
+            columns[name + '_upper'] = upper[i]
+
+        return DataFrame(columns, index=list(thresholds))
+
+
+    def precision_recall_curve(self, points=100):
+        """
+        Returns a dataframe of precision and recall when the top k% of scores
+        are classified as true, indexed by k.
+
+        k takes points evenly spaced values up to 100, or every possible cutoff
+        if points is None. The whole curve comes from one cumulative sum.
+        """
+        n = len(self.actual)
+        cum_true = np.concatenate(([0], np.cumsum(self.actual)))
+
+        if points is None:
+            cutoffs = np.arange(1, n + 1)
+            percents = cutoffs / n * 100
+        else:
+            percents = np.linspace(0, 100, points + 1)[1:]
+            cutoffs = self._cutoffs(percents)
+
+        _, precision, recall, _, _ = _threshold_metrics(cum_true[cutoffs],
+                                                        cutoffs,
+                                                        cum_true[-1], n)
+        return DataFrame({ 'precision': precision, 'recall': recall },
+                         index=percents)
+
+
+    def _cutoffs(self, thresholds):
+        # Cutoff rule stolen from Rayid Ghani
+        n = len(self.actual)
+        return (n * (np.asarray(thresholds, dtype=float) / 100.0)).astype(int)
+
+
+    def _group_counts(self):
+        """
+        Returns the cumulative true and false positive counts at the end of
+        each group of tied scores.
+        """
+        group_ends = np.flatnonzero(np.diff(self.score) != 0)
+        group_ends = np.append(group_ends, len(self.score) - 1)
+        tp = np.cumsum(self.actual)[group_ends]
+        fp = group_ends + 1 - tp
+        return tp, fp
+
 
+    def _roc_points(self):
+        tp, fp = self._group_counts()
+        fpr = np.concatenate(([0], fp / fp[-1]))
+        tpr = np.concatenate(([0], tp / tp[-1]))
+        return fpr, tpr
+
+
+    def _sort(self, actual, score, predict):
+        score = np.asarray(score, dtype=float)
+        order = np.argsort(-score, kind='mergesort')
+        self.actual = _read_only(np.asarray(actual, dtype=float)[order])
+        self.score = _read_only(score[order])
+        self.predict = _read_only(np.asarray(predict, dtype=float)[order])
+
+
+    def _at_threshold(self, metric):
+        return self.metrics_at([self.threshold])[metric].iloc[0]
 
 class ResultCollection:
     """
     Wrapper around a collection of PredictionResult data that can draw graphs.
+
+    Metrics are stored in long form, one value per (model, params, split,
+    threshold, metric). Where a model has a single result, the result itself is
+    also kept in results, so that curves can be drawn from it. Each join
+    appends a block of arrays, and the tidy and wide dataframes are built from
+    the blocks when they are needed.
+
+    The wide dataframe (df) has one column per metric and model, named
+    metric_model, and one row per split (or per threshold, if the results
+    are for different thresholds of a single test set).
     """
-    def __init__(self, df=DataFrame()):
-        self.df = df
-        self.suffixes = []
+    def __init__(self, df=None):
+        self._blocks = []
+        self._records = None
+        self.results = {}
+        if df is not None and len(df.columns) > 0:
+            self._append(None, None, list(df.index), [None] * len(df),
+                         list(df.columns), df.values)
+
+
+    @property
+    def records(self):
+        """
+        Returns a tidy dataframe with model, params, split, threshold, metric
+        and value columns.
+        """
+        if self._records is None:
+            self._records = self._build_records()
+
+        return self._records
 
 
-    def join(self, suffix, result_or_collection):
+    @property
+    def suffixes(self):
+        return [model for model in pd.unique(self.records.model)
+                if model is not None]
+
+
+    @property
+    def df(self):
+        wide = self._pivot(['model', 'metric'])
+
+        # Group columns by model, like a series of joins would
+        models = list(pd.unique(self.records.model.fillna('')))
+        metrics = list(pd.unique(self.records.metric))
+        columns = sorted(wide.columns, key=lambda c: (models.index(c[0]),
+                                                      metrics.index(c[1])))
+        wide = wide[columns]
+        wide.columns = [metric + '_' + model if model else metric
+                        for model, metric in columns]
+        return wide
+
+
+    def join(self, suffix, result_or_collection, params=None):
         if isinstance(result_or_collection, PredictionResult):
             collection = ResultCollection.from_stack([result_or_collection])
         else:
             collection = result_or_collection
 
-        incoming_df = collection.df.copy(deep=False)
-
-        incoming_df.columns = \
-            [colname + '_' + suffix for colname in incoming_df.columns]
+        for model, block_params, *rest in collection._blocks:
+            model = suffix if model is None else model + '_' + suffix
+            self._append(model, params or block_params, *rest)
 
-        self.df = self.df.join(incoming_df, how='right')
-        self.suffixes.append(suffix)
+        for model, result in collection.results.items():
+            model = suffix if model is None else model + '_' + suffix
+            self.results[model] = result
 
 
     def statistic(self, stat_name):
-        df = self.df.filter(regex=stat_name).transpose()
-        df.index = self.suffixes
-        df.columns = [f"split{i}" for i in range(1, len(self.df) + 1)]
+        df = self._pivot('model', metric=stat_name).transpose()
+        df = df.loc[[s for s in self.suffixes if s in df.index]]
+        df.columns = [f"split{i}" for i in range(1, len(df.columns) + 1)]
         return df
 
 
     def plot_statistic(self, stat_name, xlabel='split', ylim=None, filename=None):
-        stat_df = self.df.filter(regex=stat_name)
-        stat_df.columns = self.suffixes
+        stat_df = self._pivot('model', metric=stat_name)
+        suffixes = [s for s in self.suffixes if s in stat_df.columns]
+        stat_df = stat_df[suffixes]
 
         if len(stat_df.index) > 1:
             plt.figure(figsize=(6, 6))
-            for suffix in self.suffixes:
+            for suffix in suffixes:
                 plt.plot([str(x) for x in stat_df.index.values],
                          stat_df[suffix].values,
                          label=suffix)
@@ -159,16 +395,25 @@ class ResultCollection:
             plt.savefig(filename)
 
 
-    def plot_precision_recall(self, model_name, filename=None):
+    def plot_precision_recall(self, model_name, filename=None, points=100):
+        """
+        Plots precision and recall against the threshold.
+
+        If the collection holds the model's full result, the curve is drawn at
+        points thresholds (or every cutoff if points is None). Otherwise only
+        the thresholds that were evaluated are drawn.
+        """
         plt.figure(figsize=(6, 6))
-        plt.plot([str(x) for x in self.df.index.values],
-                 self.df['precision_' + model_name].values,
-                 label='precision',
-                 color='red')
-        plt.plot([str(x) for x in self.df.index.values],
-                 self.df['recall_' + model_name].values,
-                 label='recall',
-                 color='blue')
+
+        if model_name in self.results:
+            df = self.results[model_name].precision_recall_curve(points)
+            x = df.index.values
+        else:
+            df = self._pivot('metric', model=model_name)
+            x = [str(x) for x in df.index.values]
+
+        plt.plot(x, df['precision'].values, label='precision', color='red')
+        plt.plot(x, df['recall'].values, label='recall', color='blue')
         plt.legend()
 
         plt.xlabel('threshold')
@@ -179,7 +424,184 @@ class ResultCollection:
             plt.savefig(filename)
 
 
-    def from_stack(results, index=None):
+    def from_named(named):
+        """
+        Returns a collection that joins every named result or collection,
+        using the names as suffixes.
+        """
+        collection = ResultCollection()
+        for suffix, result_or_collection in named.items():
+            collection.join(suffix, result_or_collection)
+
+        return collection
+
+
+    def from_stack(results, index=None, n_resamples=None, alpha=0.05,
+                   seed=None):
+        """
+        Returns a collection with one row of metrics per result.
+
+        If n_resamples is given, bootstrap confidence intervals are added for
+        the metrics of results that have a threshold.
+        """
         index = index or list(range(1, len(results) + 1))
-        return ResultCollection(DataFrame([r.as_series() for r in results],
-                                          index=index))
+        series = [r.as_series() for r in results]
+        if n_resamples:
+            series = [_with_intervals(s, r, n_resamples, alpha, seed)
+                      for s, r in zip(series, results)]
+
+        collection = ResultCollection()
+        collection._append(None, None, index, [r.threshold for r in results],
+                           list(series[0].index),
+                           np.array([s.values for s in series]))
+        if len(results) == 1:
+            collection.results[None] = results[0]
+
+        return collection
+
+
+    def from_thresholds(result, thresholds, n_resamples=None, alpha=0.05,
+                        seed=None, n_jobs=None):
+        """
+        Returns a collection of the result's metrics at every threshold.
+
+        If n_resamples is given, bootstrap confidence intervals for the
+        threshold metrics are included as _lower and _upper metrics.
+        """
+        if n_resamples:
+            df = result.bootstrap(thresholds, n_resamples, alpha, seed, n_jobs)
+        else:
+            df = result.metrics_at(thresholds)
+
+        for name, value in result.ranking_metrics().items():
+            df[name] = value
+
+        collection = ResultCollection()
+        collection._append(None, None, [None] * len(thresholds), thresholds,
+                           list(df.columns), df.values)
+        collection.results[None] = result
+        return collection
+
+
+    def _append(self, model, params, splits, thresholds, metrics, values):
+        values = np.asarray(values, dtype=float)
+        self._blocks.append((model, params, list(splits), list(thresholds),
+                             list(metrics), values))
+        self._records = None
+
+
+    def _build_records(self):
+        columns = { 'model': [], 'params': [], 'split': [], 'threshold': [],
+                    'metric': [], 'value': [] }
+        for model, params, splits, thresholds, metrics, values in self._blocks:
+            n, m = values.shape
+            columns['model'].append(np.full(n * m, model, dtype=object))
+            columns['params'].append(np.full(n * m, params, dtype=object))
+            columns['split'].append(np.repeat(np.array(splits, dtype=object),
+                                              m))
+            columns['threshold'].append(
+                np.repeat(np.array(thresholds, dtype=object), m))
+            columns['metric'].append(np.tile(np.array(metrics, dtype=object),
+                                             n))
+            columns['value'].append(values.ravel())
+
+        if not self._blocks:
+            return DataFrame(columns=list(columns))
+
+        return DataFrame({name: np.concatenate(arrays)
+                          for name, arrays in columns.items()})
+
+
+    def _pivot(self, columns, **filters):
+        """
+        Returns the values as a wide dataframe indexed by split, or by
+        threshold if no results are for a particular split.
+        """
+        # Unnamed results would be dropped as null group keys
+        records = self.records.assign(model=self.records.model.fillna(''))
+        for name, value in filters.items():
+            records = records[records[name] == value]
+
+        index = 'threshold' if records.split.isnull().all() else 'split'
+        wide = records.pivot_table(index=index, columns=columns,
+                                   values='value', aggfunc='first',
+                                   dropna=False)
+
+        # pivot_table sorts its keys and fills in every combination of them,
+        # so keep only the keys that were recorded, in the order they were
+        wide = wide.reindex(index=records[index].dropna().unique(),
+                            columns=records.set_index(columns).index.unique())
+        wide.index.name = None
+        wide.columns.name = None
+        return wide
+
+
+def _with_intervals(series, result, n_resamples, alpha, seed):
+    names = [f"{name}_{bound}" for name in THRESHOLD_METRICS
+             for bound in ('lower', 'upper')]
+    if result.threshold is None:
+        intervals = Series(np.nan, index=names)
+    else:
+        df = result.bootstrap([result.threshold], n_resamples, alpha, seed)
+        intervals = df.iloc[0][names]
+
+    return pd.concat([series, intervals])
+
+
+def _threshold_metrics(tp, cutoffs, n_true, n):
+    """
+    Returns accuracy, precision, recall, f1 and auc arrays for predictions that
+    classify the top cutoffs rows as true, given the true positive counts.
+    """
+    fp = cutoffs - tp
+    n_false = n - n_true
+    tn = n_false - fp
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Follows sklearn in scoring undefined ratios as zero
+        precision = np.where(cutoffs > 0, tp / cutoffs, 0.0)
+        recall = np.where(n_true > 0, tp / n_true, 0.0)
+        f1 = np.where(cutoffs + n_true > 0, 2 * tp / (cutoffs + n_true), 0.0)
+
+        # AUC of a hard prediction is the mean of TPR and TNR
+        auc = (tp / n_true + tn / n_false) / 2
+
+    return (tp + tn) / n, precision, recall, f1, auc
+
+
+def _bootstrap_batch(actual, cutoffs, size, seed):
+    """
+    Returns an array of threshold metrics with shape (size, metric, cutoff)
+    for size resamples of the sorted actual values.
+
+    A resample is stored as the number of times each row was drawn. Since the
+    rows are sorted by score, the top k rows of a resample are found from the
+    cumulative counts.
+    """
+    rand = np.random.RandomState(seed)
+    n = len(actual)
+    draws = rand.randint(0, n, size=(size, n))
+    offsets = n * np.arange(size)[:, np.newaxis]
+    counts = np.bincount((draws + offsets).ravel(), minlength=size * n)
+    counts = counts.reshape(size, n)
+
+    cum_count = np.cumsum(counts, axis=1)
+    cum_true = np.cumsum(counts * actual, axis=1)
+    n_true = cum_true[:, -1]
+
+    rows = np.arange(size)
+    tp = np.empty((size, len(cutoffs)))
+    for i, k in enumerate(cutoffs):
+        # Row j holds the k-th draw, so only some of its copies may count
+        j = np.minimum((cum_count < k).sum(axis=1), n - 1)
+        count_before = np.where(j > 0, cum_count[rows, j - 1], 0)
+        true_before = np.where(j > 0, cum_true[rows, j - 1], 0)
+        tp[:, i] = true_before + (k - count_before) * actual[j]
+
+    metrics = _threshold_metrics(tp, cutoffs, n_true[:, np.newaxis], n)
+    return np.stack(metrics, axis=1)
+
+
+def _read_only(narray):
+    narray.setflags(write=False)
+    return narray
@@ -0,0 +1,143 @@
+"""
+This module contains a parameter search engine built on top of Trainer and
+Tester.
+"""
+import itertools
+import numpy as np
+from .result import ResultCollection
+
+class Search:
+    """
+    Searches over the parameters of Trainer methods.
+
+    Configurations are trained and tested one split at a time. If keep is
+    given, only that fraction of the configurations (ranked by their mean
+    metric on the splits seen so far) goes on to the next split, so bad
+    configurations stop early.
+
+    Fitted models are cached by (method, params, split), so repeated searches
+    only fit configurations that have not been seen before.
+
+    The default metric, roc_auc, ranks configurations by their scores. Metrics
+    of hard predictions, like precision, should be used with a threshold.
+    """
+    def __init__(self, trainer, tester, metric='roc_auc', threshold=None,
+                 keep=None):
+        if len(trainer.dfs) != len(tester.dfs):
+            raise Exception(f"Number of training sets ({len(trainer.dfs)})"
+                            f" does not match test sets ({len(tester.dfs)}).")
+
+        self.trainer = trainer
+        self.tester = tester
+        self.metric = metric
+        self.threshold = threshold
+        self.keep = keep
+        self.models = {}
+        self.results = {}
+
+
+    def grid(self, grid):
+        """
+        Tries every combination of parameters in the grid.
+
+        The grid is a dictionary with method names as keys and dictionaries
+        mapping parameter names to lists of values as values.
+        """
+        return self._run(_configurations(grid))
+
+
+    def random(self, grid, n_iter, seed=None):
+        """
+        Tries n_iter combinations of parameters drawn at random from the grid.
+        """
+        configs = _configurations(grid)
+        if n_iter < len(configs):
+            rand = np.random.RandomState(seed)
+            picks = sorted(rand.choice(len(configs), n_iter, replace=False))
+            configs = [configs[i] for i in picks]
+
+        return self._run(configs)
+
+
+    def best(self):
+        """
+        Returns the (method, params) pair with the best mean metric over all
+        splits.
+        """
+        n_splits = len(self.trainer.dfs)
+        finished = [config for config, results in self.results.items()
+                    if len(results) == n_splits]
+        if not finished:
+            raise Exception("No configuration has been tested on every split"
+                            " yet. Run a search first.")
+
+        method, params = max(finished, key=self._mean_metric)
+        return method, dict(params)
+
+
+    def _run(self, configs):
+        alive = configs
+        for split in range(len(self.trainer.dfs)):
+            self._fit(alive, split)
+
+            untested = [config for config in alive
+                        if split not in self.results.get(config, {})]
+            tested = self.tester._test_many([(self.models[config + (split,)],
+                                              split)
+                                             for config in untested])
+            for config, result in zip(untested, tested):
+                if self.threshold:
+                    result = result.with_threshold(self.threshold)
+
+                self.results.setdefault(config, {})[split] = result
+
+            if self.keep:
+                n_keep = max(int(np.ceil(len(alive) * self.keep)), 1)
+                alive = sorted(alive, key=self._mean_metric,
+                               reverse=True)[:n_keep]
+
+        return self._collection(configs)
+
+
+    def _fit(self, configs, split):
+        pending = [config for config in configs
+                   if config + (split,) not in self.models]
+        unfitted = [self.trainer.model(method, **dict(params))
+                    for method, params in pending]
+        fitted = self.trainer._fit_many(unfitted, splits=[split])
+        for config, (model,) in zip(pending, fitted):
+            self.models[config + (split,)] = model
+
+
+    def _mean_metric(self, config):
+        results = self.results[config].values()
+        return np.mean([getattr(result, self.metric)() for result in results])
+
+
+    def _collection(self, configs):
+        collection = ResultCollection()
+        for config in configs:
+            results = self.results[config]
+            splits = sorted(results)
+            stack = ResultCollection.from_stack([results[i] for i in splits],
+                                                index=[i + 1 for i in splits])
+            collection.join(_config_name(config), stack,
+                            params=dict(config[1]))
+
+        return collection
+
+
+def _configurations(grid):
+    configs = []
+    for method, space in grid.items():
+        keys = sorted(space)
+        for values in itertools.product(*[space[key] for key in keys]):
+            configs.append((method, tuple(zip(keys, values))))
+
+    return configs
+
+
+def _config_name(config):
+    method, params = config
+    pretty = ', '.join(f"{key}={value}" for key, value in params)
+    return f"{method}({pretty})"
@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+
+class TemporalSplitter:
+    """
+    Generates training and test sets that move forward in time along a date
+    column.
+
+    Each test set covers test_window. The first test window starts after one
+    training window (or one test window, if training sets expand), and each
+    later window starts step after the one before it (default test_window).
+    Like time_split, only whole test windows are used, so rows after the last
+    one that fits before end are never tested.
+
+    If train_window is None, training sets expand to include all earlier rows.
+    Otherwise they slide, covering only train_window. Rows within gap of the
+    start of the test window are left out of the training set, so that labels
+    that take gap to be known do not leak into training.
+    """
+    def __init__(self, colname, test_window, train_window=None, gap=None,
+                 step=None):
+        self.colname = colname
+        self.test_window = test_window
+        self.train_window = train_window
+        self.gap = gap
+        self.step = step or test_window
+
+
+    def split(self, df, begin=None, end=None):
+        """
+        Lazily yields (train, test) arrays of row positions into the dataframe.
+
+        begin and end default to the earliest and latest dates in the column.
+        Rows with a missing date are never included.
+        """
+        order, bounds = self._sort(df, begin, end)
+        for train_start, train_end, test_start, test_end in bounds:
+            yield order[train_start:train_end], order[test_start:test_end]
+
+
+    def frames(self, df, begin=None, end=None, remove_date=False):
+        """
+        Lazily yields (df_train, df_test) pairs.
+
+        The dataframe is sorted by the date column once, and each pair is a
+        slice of the sorted dataframe.
+        """
+        order, bounds = self._sort(df, begin, end)
+        df_sorted = df.iloc[order]
+        if remove_date:
+            df_sorted = df_sorted.drop(columns=[self.colname])
+
+        for train_start, train_end, test_start, test_end in bounds:
+            yield (df_sorted.iloc[train_start:train_end],
+                   df_sorted.iloc[test_start:test_end])
+
+
+    def _sort(self, df, begin, end):
+        dates = df[self.colname].values
+        order = np.argsort(dates, kind='mergesort')
+        sorted_dates = dates[order]
+
+        # NaT sorts last
+        present = sorted_dates[~pd.isnull(sorted_dates)]
+        begin = present[0] if begin is None else begin
+        end = present[-1] if end is None else end
+        return order, self._bounds(sorted_dates, begin, end)
+
+
+    def _bounds(self, sorted_dates, begin, end):
+        """
+        Lazily yields the positions that delimit each training and test set in
+        the sorted dates.
+
+        Training sets cover (train_begin, train_end] and test sets cover
+        (test_begin, test_end], like time_split. The last test window ends at
+        or before end.
+        """
+        def position(date):
+            date = np.array(date, dtype=sorted_dates.dtype)
+            return np.searchsorted(sorted_dates, date, side='right')
+
+        gap = self.gap if self.gap is not None else pd.Timedelta(0)
+        test_begin = begin + (self.train_window or self.test_window) + gap
+        while test_begin + self.test_window <= end:
+            train_end = test_begin - gap
+            if self.train_window is None:
+                train_start = 0
+            else:
+                train_start = position(train_end - self.train_window)
+
+            yield (train_start,
+                   position(train_end),
+                   position(test_begin),
+                   position(test_begin + self.test_window))
+
+            test_begin = test_begin + self.step
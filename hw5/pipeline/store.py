@@ -0,0 +1,106 @@
+"""
+This module contains a disk-backed store for fitted models.
+
+Models are keyed by a hash of their training data, their parameters and an
+optional cleaning configuration, so a model only has to be fitted again when
+one of those changes.
+"""
+import os
+import hashlib
+import joblib
+import numpy as np
+import scipy.sparse
+
+class ModelStore:
+    """
+    Persists fitted models in a directory using joblib.
+
+    If max_bytes is given, the least recently used models are evicted once the
+    store grows past that size. Models are loaded with the given mmap_mode, so
+    large arrays inside them can be memory-mapped instead of read into memory.
+    """
+    def __init__(self, path='models/', max_bytes=None, config=None,
+                 mmap_mode=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.config = config
+        self.mmap_mode = mmap_mode
+        os.makedirs(path, exist_ok=True)
+
+
+    def key(self, model, data_hash):
+        """
+        Returns the key for an unfitted model trained on data with the given
+        hash.
+        """
+        params = sorted(model.get_params(deep=True).items())
+        description = repr((type(model).__qualname__,
+                            params,
+                            data_hash,
+                            self.config))
+        return hashlib.sha256(description.encode()).hexdigest()
+
+
+    def get(self, key):
+        """
+        Returns the model stored under the key, or None if there isn't one.
+        """
+        filename = self._filename(key)
+        try:
+            model = joblib.load(filename, mmap_mode=self.mmap_mode)
+        except FileNotFoundError:
+            return None
+
+        # Mark as recently used
+        os.utime(filename)
+        return model
+
+
+    def put(self, key, model):
+        filename = self._filename(key)
+        tmp_filename = f"{filename}.{os.getpid()}.tmp"
+        joblib.dump(model, tmp_filename)
+        os.replace(tmp_filename, filename)
+        self._evict()
+
+
+    def _evict(self):
+        if self.max_bytes is None:
+            return
+
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.joblib'):
+                stat = os.stat(os.path.join(self.path, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+
+            os.remove(os.path.join(self.path, name))
+            total -= size
+
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + '.joblib')
+
+
+def data_hash(*arrays):
+    """
+    Returns a hash of the contents of the given dense or sparse arrays.
+    """
+    h = hashlib.sha256()
+    for a in arrays:
+        if scipy.sparse.issparse(a):
+            a = a.tocsr()
+            parts = [a.data, a.indices, a.indptr]
+        else:
+            parts = [a]
+
+        h.update(repr((a.shape, str(a.dtype))).encode())
+        for part in parts:
+            h.update(np.ascontiguousarray(part).data)
+
+    return h.hexdigest()
@@ -1,5 +1,114 @@
+import os
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from pandas._libs.sparse import IntIndex
+
 def wrap_list(maybe_list):
     if isinstance(maybe_list, list):
         return maybe_list
     else:
         return [maybe_list]
+
+
+def worker_count(n_jobs):
+    """
+    Returns the number of workers to use given an sklearn-style n_jobs value.
+
+    None means one worker; negative values count back from the number of CPUs,
+    so -1 means use all of them.
+    """
+    if n_jobs is None:
+        return 1
+    elif n_jobs < 0:
+        return max(os.cpu_count() + 1 + n_jobs, 1)
+    else:
+        return n_jobs
+
+
+def sparse_frame(m, index, columns):
+    """
+    Returns a dataframe of sparse columns, filled with 0, holding the sparse
+    matrix.
+
+    Each column is built from the stored values of a column of the matrix, so
+    the matrix is never densified.
+    """
+    m = scipy.sparse.csc_matrix(m)
+    m.sort_indices()
+    arrays = {}
+    for j, name in enumerate(columns):
+        start, end = m.indptr[j], m.indptr[j + 1]
+        sp_index = IntIndex(m.shape[0], m.indices[start:end])
+        arrays[name] = pd.arrays.SparseArray(m.data[start:end],
+                                             sparse_index=sp_index,
+                                             fill_value=0)
+
+    return pd.DataFrame(arrays, index=index)
+
+
+def feature_matrix(df, label_colname, sparse=False, dtype=np.float64):
+    """
+    Returns the feature columns of the dataframe as a matrix of the given
+    dtype.
+
+    If sparse is set, returns a CSR matrix. Sparse columns filled with 0 are
+    converted from their stored values, so they are never densified.
+    Otherwise returns a C-contiguous array.
+    """
+    df_features = df.drop(columns=[label_colname])
+    if not sparse:
+        return np.ascontiguousarray(df_features.to_numpy(dtype=dtype))
+
+    rows, cols, values = [], [], []
+    for j, colname in enumerate(df_features.columns):
+        column = df_features[colname].array
+        if isinstance(column.dtype, pd.SparseDtype) \
+                and column.fill_value == 0:
+            row = column.sp_index.to_int_index().indices
+            value = column.sp_values
+        else:
+            value = np.asarray(column, dtype=dtype)
+            row = np.flatnonzero(value)
+            value = value[row]
+
+        rows.append(row)
+        cols.append(np.full(len(row), j))
+        values.append(value.astype(dtype))
+
+    shape = (len(df_features), len(df_features.columns))
+    return scipy.sparse.csr_matrix((np.concatenate(values),
+                                    (np.concatenate(rows),
+                                     np.concatenate(cols))),
+                                   shape=shape, dtype=dtype)
+
+
+class Reservoir:
+    """
+    Keeps a uniform random sample of at most size rows from a stream of row
+    batches.
+    """
+    def __init__(self, size, seed=None):
+        self.size = size
+        self.seen = 0
+        self.sample = None
+        self.rand = np.random.RandomState(seed)
+
+
+    def add(self, rows):
+        rows = np.asarray(rows)
+        n_fill = min(max(self.size - self.seen, 0), len(rows))
+        if self.sample is None:
+            self.sample = rows[:n_fill].copy()
+        elif n_fill:
+            self.sample = np.concatenate([self.sample, rows[:n_fill]])
+
+        # Row i of the stream replaces a random slot with probability
+        # size / (i + 1)
+        rest = rows[n_fill:]
+        ids = self.seen + n_fill + np.arange(len(rest))
+        slots = (self.rand.random_sample(len(rest)) * (ids + 1)).astype(int)
+        replace = slots < self.size
+        self.sample[slots[replace]] = rest[replace]
+
+        self.seen += len(rows)